@@ -1,8 +1,15 @@
 # Import libraries
 import os
+import sys
+import time
+import shutil
+import tempfile
+import hashlib
+import multiprocessing
 import cv2
 import numpy as np
 import skimage.io as io
+import tifffile
 from skimage import transform, img_as_int, img_as_ubyte, img_as_float
 from skimage.filters import median, sobel, hessian, gabor, gaussian, scharr
 from skimage.segmentation import clear_border
@@ -13,12 +20,24 @@ import scipy.ndimage as spim
 import scipy.spatial as sptl
 from tabulate import tabulate
 import pickle
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
 from PIL import Image
 from tqdm import tqdm
 from numba import jit
 import sklearn as skl
 from sklearn.preprocessing import LabelEncoder
 from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+try:
+    from sklearn.ensemble import HistGradientBoostingClassifier
+except ImportError:
+    try:
+        from sklearn.experimental import enable_hist_gradient_boosting # scikit-learn 0.21 to 0.24
+        from sklearn.ensemble import HistGradientBoostingClassifier
+    except ImportError:
+        HistGradientBoostingClassifier = None # requires scikit-learn >= 0.21
 from sklearn.metrics import accuracy_score, confusion_matrix
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -26,6 +45,9 @@ from scipy import misc
 from scipy.ndimage.filters import maximum_filter, median_filter, minimum_filter, percentile_filter
 from scipy.ndimage.morphology import distance_transform_edt
 import vtk
+import smooth_stl
+import leaf_traits
+import volume_store
 # Suppress all warnings (not errors) by uncommenting next two lines of code
 import warnings
 warnings.filterwarnings("ignore")
@@ -36,125 +58,137 @@ gauss_sd_list = [2,4,8,16,32,64] #six different filters with different sd for ea
 gauss_length = 2*len(gauss_sd_list)
 hess_range = [4,64]
 hess_step = 4
-num_feature_layers = 37 # grid and phase recon; plus gaussian blurs; plus hessian filters
+
+# Feature bank; one (filter, source, parameter) entry per feature layer (FL) column, in column order
+# Sources are the grid/phase recon slices, their Sobel edge maps, local thickness and distance from edge
+# Training, test-set and full stack prediction all build their FL arrays from this one list
+feature_bank = [
+    ("raw", "grid", None), ("raw", "phase", None),
+    ("gaussian", "grid", 8), ("gaussian", "phase", 8),
+    ("gaussian", "grid", 64), ("gaussian", "phase", 64),
+    ("variance", "grid", 9), ("variance", "phase", 9),
+    ("variance", "grid", 18), ("variance", "phase", 18),
+    ("variance", "grid", 36), ("variance", "phase", 36),
+    ("variance", "grid", 72), ("variance", "phase", 72),
+    ("raw", "localthick", None), ("raw", "dist_edge", None),
+    ("gaussian", "grid", 4), ("gaussian", "phase", 4),
+    ("gaussian", "grid", 32), ("gaussian", "phase", 32),
+    ("raw", "sobel_grid", None), ("raw", "sobel_phase", None),
+    ("gaussian", "sobel_grid", 8), ("gaussian", "sobel_phase", 8),
+    ("gaussian", "sobel_grid", 32), ("gaussian", "sobel_phase", 32),
+    ("gaussian", "sobel_grid", 64), ("gaussian", "sobel_phase", 64),
+    ("gaussian", "sobel_grid", 128), ("gaussian", "sobel_phase", 128),
+    ("variance", "sobel_grid", 32), ("variance", "sobel_phase", 32),
+    ("variance", "sobel_grid", 64), ("variance", "sobel_phase", 64),
+    ("variance", "sobel_grid", 128), ("variance", "sobel_phase", 128),
+    ("raw", "localthick_min3", None)]
+feature_bank_version = 3 # bump whenever feature_bank or its filters change; models trained on other versions are incompatible
+num_feature_layers = len(feature_bank) # grid and phase recon; plus gaussian blurs; plus variance filters; plus local thickness
+gauss_pyramid_min_sd = 32 # gaussian blurs with sd >= this are computed on a shared gaussian pyramid of the source
+feature_dtype = np.float32 # dtype of feature layer arrays; sklearn's trees work in float32 internally
+label_dtype = np.uint8 # dtype of encoded labels and class predictions
+artifact_compress = 0 # joblib compression level (0-9) for the saved model and feature arrays; 0 lets them load memory-mapped
+feature_cache_dir = None # folder to keep feature layers of training/testing slices in, keyed by content (e.g. '../results/feature_cache'); never cleaned up, None disables
+
+# Full stack prediction parameters
+predict_workers = 1 # worker processes for full stack prediction; 1 predicts serially in this process
+predict_block_size = 4 # consecutive slices handed to a prediction worker per task
+compiled_inference = True # predict with random forests through CompiledForest (same predictions, faster); False uses scikit-learn's predict
+forest_branchless_depth = 20 # CompiledForest steps trees up to this depth level by level without branching, which is faster for shallow trees; deeper trees are walked row by row
+predict_coarse_step = 1 # predict every n-th pixel of each slice first, then re-predict at full resolution only near class changes and unsure pixels; 1 predicts every pixel
+predict_refine_confidence = 0.7 # coarse predictions with a lower class probability are re-predicted at full resolution
+coarse_report_steps = [2, 4, 8] # coarse steps compared with exhaustive prediction by coarse_to_fine_report
+prediction_store_dir = 'prediction_store' # full stack predictions are kept slice by slice in this results subfolder, so re-runs only predict new or stale slices and resume after a crash; None disables
+coarse_report_slices = 10 # evenly spaced slices predicted by coarse_to_fine_report; None uses every slice
+predict_streaming = False # Read From File Mode: predict the full stack out-of-core with RFPredictCTStackStreaming
+predict_sections = ["transverse", "paradermal", "longitudinal"] # sections predicted, each with its own model, by RFPredictCTStackEnsemble; their class probabilities are averaged
+section_train_planes = 32 # evenly spaced paradermal/longitudinal planes whose pixels in the labeled training slices train those sections' models
+predict_section_ensemble = False # Read From File Mode: predict the full stack with RFPredictCTStackEnsemble over predict_sections
+
+# Training parameters
+# Classifier backends: name -> (classifier, parameters). The limited forest caps tree size, so full stacks predict faster
+classifier_backends = {
+    "random_forest": (RandomForestClassifier, {"n_estimators": 50, "oob_score": True, "n_jobs": -1, "warm_start": False}), #, "class_weight": "balanced"
+    "limited_forest": (RandomForestClassifier, {"n_estimators": 50, "max_depth": 16, "min_samples_leaf": 20, "oob_score": True, "n_jobs": -1}),
+    "hist_gradient_boosting": (HistGradientBoostingClassifier, {"max_iter": 100, "max_leaf_nodes": 31, "early_stopping": False})}
+classifier_backend = "random_forest" # classifier_backends entry used by train_model
+train_report_backends = None # backends compared by training_budget_report; None compares classifier_backend only
+train_pixels_per_class = None # most pixels of each class used to fit the model, spread over all training slices; None uses every pixel
+train_report_budgets = [10000, 50000, 200000, None] # per-class budgets compared by training_budget_report
+
+# Intermediate stack parameters
+intermediate_store = True # save intermediate stacks (thresholded, local thickness, predictions) as chunked volume stores ('<name>.chunks' folders, see volume_store) that are read a chunk at a time; False saves .tif stacks
+export_tif_copies = True # also export full stack predictions and post-processed stacks saved as chunked volume stores to .tif, for ImageJ/FIJI
+
+# Local thickness parameters
+localthick_scale = 0.25 # scale at which local thickness is computed; 1 computes it at full resolution
+
+# Post-processing parameters
+postprocess_workers = 1 # worker processes for PostProcessStack; 1 post-processes serially in this process
+postprocess_slab_size = 32 # transverse slices post-processed per task by PostProcessStack
+postprocess_halo = 30 # slices of context on each side of a slab; the z percentile filters of final_smooth reach 30 slices
 
 # Import label encoder
 labenc = LabelEncoder()
 
+@jit(nopython=True, cache=True)
+def _label_bounds(img, labels):
+    # First and last row (axis 1) of each label in every (z, x) column of img, and the first row holding
+    # any other value; -1 where there is none. One pass over img, rows in memory order
+    nz, ny, nx = img.shape
+    n = labels.shape[0]
+    first = np.full((n,nz,nx), -1, dtype=np.int64)
+    last = np.full((n,nz,nx), -1, dtype=np.int64)
+    first_other = np.full((n,nz,nx), -1, dtype=np.int64)
+    for i in range(nz):
+        for j in range(ny):
+            for k in range(nx):
+                v = img[i,j,k]
+                for c in range(n):
+                    if v == labels[c]:
+                        if first[c,i,k] < 0:
+                            first[c,i,k] = j
+                        last[c,i,k] = j
+                    elif first_other[c,i,k] < 0:
+                        first_other[c,i,k] = j
+    return first, last, first_other
+
+def fill_edge_gaps(edge, gap):
+    # Replace gap entries of a (z, x) edge map, from the third column on, with the nearest non-gap entry to their left
+    cols = np.arange(edge.shape[1])
+    idx = np.maximum.accumulate(np.where(~gap | (cols <= 1), cols, 0), axis=1)
+    return np.take_along_axis(edge, idx, axis=1)
+
 def smooth_epidermis(img,epidermis,background,spongy,palisade,ias,vein):
-    # FIX: clean this up, perhaps break into multiple functions
-    # Define 3D array of distances from lower and upper epidermises
-    a = range(0,img.shape[1])
-    b = np.tile(a,(img.shape[2],img.shape[0],1))
-    b = np.moveaxis(b,[0,1,2],[2,0,1])
-    # Determine the lower edge of the spongy mesophyll
-    c = (img==spongy)
-    d = (b*c)
-    s_low = np.argmax(d, axis=1)
-    s_low_adjust = np.array(s_low, copy=True)
-    s_low_adjust[(s_low==img.shape[1])] = 0
-    # Determine the lower edge of the palisade mesophyll
-    c = (img==palisade)
-    d = (b*c)
-    p_low = np.argmax(d, axis=1)
-    p_low_adjust = np.array(p_low, copy=True)
-    p_low_adjust[(p_low==img.shape[1])] = 0
-    # Determine the lower edge of the vascular bundle
-    c = (img==vein)
-    d = (b*c)
-    v_low = np.argmax(d, axis=1)
-    v_low_adjust = np.array(v_low, copy=True)
-    v_low_adjust[(v_low==img.shape[1])] = 0
-    # Determine the lower edge of the IAS
-    c = (img==ias)
-    d = (b*c)
-    ias_low = np.argmax(d, axis=1)
-    ias_low_adjust = np.array(ias_low, copy=True)
-    ias_low_adjust[(ias_low==img.shape[1])] = 0
-    # Determine the lower edge of the epidermis
-    c = (img==epidermis)
-    d = (b*c)
-    e_low = np.argmax(d, axis=1)
-
-    e_low = np.maximum(e_low, s_low_adjust) # Changes lowest mesophyll pixel to epidermal class
-    e_low = np.maximum(e_low, p_low_adjust) # Changes lowest mesophyll pixel to epidermal class
-    e_low = np.maximum(e_low, ias_low_adjust) # Changes lowest IAS pixel to epidermal class
-    e_low = np.maximum(e_low, v_low_adjust) # Changes lowest vein pixel to epidermal class
-
-    epi_low = np.zeros(img.shape)
-    for z in tqdm(range(0,epi_low.shape[0])):
-        for x in range(0,epi_low.shape[2]):
-            epi_low[z,e_low[z,x],x] = 1
-
-    b2 = np.flip(b,1)
-    # Determine the upper edge of spongy
-    c = (img==spongy)
-    d = ((b2)*c)
-    s_up = np.argmax(d, axis=1)
-    s_up_adjust = np.array(s_up, copy=True)
-    s_up_adjust[(s_up==0)] = img.shape[1]-1
-    # Determine the upper edge of palisade
-    c = (img==palisade)
-    d = ((b2)*c)
-    p_up = np.argmax(d, axis=1)
-    p_up_adjust = np.array(p_up, copy=True)
-    p_up_adjust[(p_up==0)] = img.shape[1]-1
-    # Determine the upper edge of ias
-    c = (img==ias)
-    d = ((b2)*c)
-    ias_up = np.argmax(d, axis=1)
-    ias_up_adjust = np.array(ias_up, copy=True)
-    ias_up_adjust[(ias_up==0)] = img.shape[1]-1
-    # Determine the upper edge of vein
-    c = (img==vein)
-    d = ((b2)*c)
-    v_up = np.argmax(d, axis=1)
-    v_up_adjust = np.array(v_up, copy=True)
-    v_up_adjust[(v_up==0)] = img.shape[1]-1
-    # Determine the upper edge of epidermis
-    c = (img==epidermis)
-    d = ((b2)*c)
-    e_up = np.argmax(d, axis=1)
-
-    e_up = np.minimum(e_up, s_up_adjust) # Changes highest spongy pixel to epidermal class
-    e_up = np.minimum(e_up, p_up_adjust) # Changes highest palisade pixel to epidermal class
-    e_up = np.minimum(e_up, ias_up_adjust) # Changes highest ias pixel to epidermal class
-    e_up = np.minimum(e_up, v_up_adjust) # Changes highest vein pixel to epidermal class
-
-    epi_up = np.zeros(img.shape)
-    for z in tqdm(range(0,epi_up.shape[0])):
-        for x in range(0,epi_up.shape[2]):
-            epi_up[z,e_up[z,x],x] = 1
-    # Generate a binary stack with the pixels inside the epidermis set equal to 1
-    epi_in = np.zeros(img.shape, dtype=np.uint16)
-    for y in tqdm(range(0,epi_in.shape[2])):
-        for z in range(0,epi_in.shape[0]):
-            epi_in[z,e_up[z,y]:e_low[z,y],y] = 1
-    # Generate a binary stack with the pixels outside the epidermis set equal to 1
-    epi_out = (epi_in==0)*1
+    # First and last row of each class in every (z, x) column
+    first, last, _ = _label_bounds(img, np.array([epidermis,spongy,palisade,ias,vein]))
+    # Determine the lower edge of the epidermis; the lowest mesophyll, IAS or vein pixel is counted as epidermis
+    e_low = np.maximum(last.max(axis=0), 0)
+    # Determine the upper edge of the epidermis; the highest mesophyll, IAS or vein pixel is counted as epidermis
+    # (classes first found on the top row are ignored)
+    e_up = np.where(first[0]==img.shape[1]-1, 0, np.maximum(first[0], 0))
+    e_up = np.minimum(e_up, np.where(first[1:] > 0, first[1:], img.shape[1]-1).min(axis=0))
+    # Binary stack with the pixels inside the epidermis set to True
+    rows = np.arange(img.shape[1]).reshape(1,-1,1)
+    epi_in = (rows >= e_up[:,np.newaxis,:]) & (rows < e_low[:,np.newaxis,:])
     # Set all background identified as IAS that lies outside epidermal boundaries as BG
     # Set all IAS identified as BG that lies within epidermal boundaries as IAS
     img2 = np.array(img, copy=True)
-    img2[(img2==ias)*(epi_out==1)] = background
-    img2[(img2==palisade)*(epi_out==1)] = background
-    img2[(img2==spongy)*(epi_out==1)] = background
-    img2[(img2==vein)*(epi_out==1)] = background
-    img2[(img2==background)*(epi_in==1)] = ias
+    img2[~epi_in & np.isin(img2, [ias,palisade,spongy,vein])] = background
+    img2[epi_in & (img2==background)] = ias
 
     return img2
 
 def final_smooth(img,vein,spongy,palisade,epidermis,ias,bg):
     vein_trace = (img==vein)
     # Remove 'dangling' vein pixels
-    vein_rmv_parts = np.array(vein_trace, copy=True)
-    for i in tqdm(range(0,vein_rmv_parts.shape[0])):
-        vein_rmv_parts[i,:,:] = remove_small_objects(vein_trace[i,:,:], min_size=600)
+    vein_rmv_parts = remove_small_objects_slicewise(vein_trace, 600, axis=0)
     # Write an array of just the removed particles
     vein_parts = vein_trace ^ vein_rmv_parts
     # Replace small vein parts with spongy mesophyll
     img[vein_parts==1] = spongy
     # Smooth veins with a double percent filter
-    vein_trace_pct = np.apply_along_axis(dbl_pct_filt, 0, arr = vein_rmv_parts)
+    vein_trace_pct = dbl_pct_filt(vein_rmv_parts, axis=0)
     invert_vt_pct = np.invert(vein_trace_pct)
     #Set all mesophyll identified as vein that lies oustide vein boundary as spongy mesophyll
     img4 = np.array(img, copy=True)
@@ -162,164 +196,193 @@ def final_smooth(img,vein,spongy,palisade,epidermis,ias,bg):
     #Set all vein identified as palisade or spongy that lies inside vein boundary as vein
     img4[(img4==palisade)*(vein_trace_pct==1)] = vein
     img4[(img4==spongy)*(vein_trace_pct==1)] = vein
-    # Define 3D array of distances from lower value of img4.shape[1] to median value
-    rangeA = range(0,img4.shape[1]/2)
-    tileA = np.tile(rangeA,(img4.shape[2],img4.shape[0],1))
-    tileA = np.moveaxis(tileA,[0,1,2],[2,0,1])
-    tileB = np.flip(tileA,1)
-    # Define 3D array of distances from median value of img4.shape[1] to upper value
-    # rangeB = range(img4.shape[1]/2,img4.shape[1])
-    # tileB = np.tile(rangeB,(img4.shape[2],img4.shape[0],1))
-    # tileB = np.moveaxis(tileB,[0,1,2],[2,0,1])
-    # tileB = np.flip(tileB,1)
-    #Make new 3d arrays of top half and lower half of image
-    hold = img4.shape[1]/2
-    img4conc1 = np.array(img4[:,0:hold,:], copy = True)
-    img4conc2 = np.array(img4[:,hold:img4.shape[1],:], copy = True)
-
-    # Determine the inner edge of the upper spongy
-    c = (img4conc1==spongy)
-    d = (tileA*c)
-    s_up_in = np.argmin(d, axis=1)
-    s_up_in_adjust = np.array(s_up_in, copy=True)
-    s_up_in_adjust[(s_up_in==0)] = hold
-    # Determine the inner edge of the upper palisade
-    c = (img4conc1==palisade)
-    d = (tileA*c)
-    p_up_in = np.argmin(d, axis=1)
-    p_up_in_adjust = np.array(p_up_in, copy=True)
-    p_up_in_adjust[(p_up_in==0)] = hold
-    # Determine the inner edge of the upper ias
-    c = (img4conc1==ias)
-    d = (tileA*c)
-    ias_up_in = np.argmin(d, axis=1)
-    ias_up_in_adjust = np.array(ias_up_in, copy=True)
-    ias_up_in_adjust[(ias_up_in==0)] = hold
-    # Determine the inner edge of the upper vein
-    c = (img4conc1==vein)
-    d = (tileA*c)
-    v_up_in = np.argmin(d, axis=1)
-    v_up_in_adjust = np.array(v_up_in, copy=True)
-    v_up_in_adjust[(v_up_in==0)] = hold
-    # Determine the inner edge of the upper epidermis
-    c = (img4conc1==epidermis)
-    d = (tileA*c)
-    e_up_in = np.argmax(d, axis=1)
-
-    e_up_in = np.minimum(e_up_in, s_up_in_adjust)
-    e_up_in = np.minimum(e_up_in, p_up_in_adjust)
-    e_up_in = np.minimum(e_up_in, ias_up_in_adjust)
-    e_up_in = np.minimum(e_up_in, v_up_in_adjust)
-
-    epi_up_in = np.zeros(img.shape)
-    for z in range(0,epi_up_in.shape[0]):
-        for x in range(0,epi_up_in.shape[2]):
-            if x > 1:
-                if e_up_in[z,x]==0 or e_up_in[z,x]==hold:
-                    e_up_in[z,x] = e_up_in[z,x-1]
-                    epi_up_in[z,e_up_in[z,x],x] = 1
-                else:
-                    epi_up_in[z,e_up_in[z,x],x] = 1
-            else:
-                epi_up_in[z,e_up_in[z,x],x] = 1
-
-    # Determine the lower edge of the spongy mesophyll
-    c = (img4conc2==spongy)
-    d = (tileB*c)
-    s_low_in = np.argmin(d, axis=1)
-    # Determins the lower edge of vein
-    c = (img4conc2==vein)
-    d = (tileB*c)
-    p_low_in = np.argmin(d,axis=1)
-    # Determine the lower edge of ias
-    c = (img4conc2==ias)
-    d = (tileB*c)
-    ias_low_in = np.argmin(d,axis=1)
-    # Determine the lower edge of vein
-    c = (img4conc2==vein)
-    d = (tileB*c)
-    v_low_in = np.argmin(d,axis=1)
-    #Determine the inner edge of the lower epidermis
-    c = (img4conc2==epidermis)
-    d = (tileB*c)
-    e_low_in = np.argmax(d, axis=1)
-    e_low_in_adjust = np.array(e_low_in, copy=True)
-    e_low_in_adjust[(e_low_in==hold)] = 0
-    e_low_in = np.maximum(e_low_in_adjust, s_low_in)
-    e_low_in = np.maximum(e_low_in_adjust, p_low_in)
-    e_low_in = np.maximum(e_low_in_adjust, ias_low_in)
-    e_low_in = np.maximum(e_low_in_adjust, v_low_in)
-
-    epi_low_in = np.zeros(img.shape)
-    for z in range(0,epi_low_in.shape[0]):
-        for x in range(0,epi_low_in.shape[2]):
-            if x > 1:
-                if e_low_in[z,x]==0 or e_low_in[z,x]==hold:
-                    e_low_in[z,x] = e_low_in[z,x-1]
-                    epi_low_in[z,e_low_in[z,x]+hold-1,x] = 1
-                else:
-                    epi_low_in[z,e_up_in[z,x]+hold-1,x] = 1
-            else:
-                epi_low_in[z,e_low_in[z,x]+hold-1,x] = 1
-
-    #add lower and upper halves
-    epi_inner_trace = np.add(epi_low_in,epi_up_in)
-    # Generate a binary stack with the pixels inside the inner epidermis trace set equal to 1
-    epi_inner_up = np.zeros(img4conc1.shape, dtype=np.uint16)
-    for y in tqdm(range(0,epi_inner_up.shape[2])):
-        for z in range(0,epi_inner_up.shape[0]):
-            epi_inner_up[z,:e_up_in[z,y],y] = 1
-
-    epi_inner_down = np.zeros(img4conc2.shape, dtype=np.uint16)
-    for y in tqdm(range(0,epi_inner_down.shape[2])):
-        for z in range(0,epi_inner_down.shape[0]):
-            epi_inner_down[z,:e_low_in[z,y],y] = 1
-    epi_inner_down = (epi_inner_down==0)*1
-    # Concatenate two halves of image
-    epi_inner_fill = np.concatenate((epi_inner_up,epi_inner_down), axis = 1)
-    epi_inner_fill_invert = (epi_inner_fill==0)*1
+    # Trace the inner edges of the epidermis in the upper and lower halves of the stack
+    hold = img4.shape[1]//2
+    n_low = img4.shape[1]-hold
+    # Determine the inner edge of the upper epidermis: its lowest pixel in the upper half
+    _, last_up, _ = _label_bounds(img4[:,:hold,:], np.array([epidermis]))
+    e_up_in = np.maximum(last_up[0], 0)
+    # Determine the inner edge of the lower epidermis: its highest pixel in the lower half,
+    # moved down past any vein that starts on the middle row
+    first_low, _, not_vein_low = _label_bounds(img4[:,hold:,:], np.array([epidermis,vein]))
+    e_low_in = np.where(first_low[0]==n_low-1, 0, np.maximum(first_low[0], 0))
+    e_low_in = np.maximum(e_low_in, np.where(not_vein_low[1] < 0, n_low-1, not_vein_low[1]))
+    # Columns without a trace take the trace of the column before
+    e_up_in = fill_edge_gaps(e_up_in, (e_up_in==0) | (e_up_in==hold))
+    e_low_in = fill_edge_gaps(e_low_in, (e_low_in==0) | (e_low_in==hold))
+    # Binary stack with the pixels outside the inner epidermis trace set to True
+    rows = np.arange(img4.shape[1]).reshape(1,-1,1)
+    epi_inner_fill = np.where(rows < hold, rows < e_up_in[:,np.newaxis,:], rows-hold >= e_low_in[:,np.newaxis,:])
     # Set all background identified as IAS that lies outside epidermal boundaries as BG
     # Set all IAS identified as BG that lies within epidermal boundaries as IAS
     img5 = np.array(img4, copy=True)
-    img5[(img4==ias)*(epi_inner_fill==1)] = bg
-    img5[(img4==bg)*(epi_inner_fill_invert==1)] = ias
+    img5[(img4==ias) & epi_inner_fill] = bg
+    img5[(img4==bg) & ~epi_inner_fill] = ias
 
     return img5
 
+def remove_small_objects_slicewise(mask, min_size, axis=0):
+    # remove_small_objects on every 2D slice of a 3D mask along axis, with a single labeling pass:
+    # the structuring element connects pixels within a slice (4-connectivity) but not across slices
+    structure = np.zeros((3,3,3), dtype=bool)
+    index = [slice(None)]*3
+    index[axis] = 1
+    structure[tuple(index)] = spim.generate_binary_structure(2,1)
+    labels, _ = spim.label(mask, structure=structure)
+    keep = np.bincount(labels.ravel()) >= min_size
+    keep[0] = False
+    return keep[labels]
+
+def keep_epidermis_xy(epid):
+    # Epidermal particles of at least 800 px^2 in each transverse (z) slice
+    return remove_small_objects_slicewise(epid, 800, axis=0)
+
+def keep_epidermis_xz(epid):
+    # Epidermal particles of at least 200 px^2 in each (z, x) slice
+    return remove_small_objects_slicewise(epid, 200, axis=1)
+
 def delete_dangling_epidermis(img,epidermis,background):
     # Remove 'dangling' epidermal pixels
     epid = (img==epidermis)
-    epid_rmv_parts = np.array(epid, copy=True)
-    for i in tqdm(range(0,epid_rmv_parts.shape[0])):
-        epid_rmv_parts[i,:,:] = remove_small_objects(epid[i,:,:], min_size=800)
-    # Write an array of just the removed particles
-    epid_parts = epid ^ epid_rmv_parts
-    # Replace the small connected epidermal particles (< 800 px^2) with BG value
-    img[epid_parts==1] = background
-    # Do this again in another dimension
-    epid2 = (epid_rmv_parts==1)
-    epid_rmv_parts2 = np.array(epid2, copy=True)
-    for j in range(0,epid_rmv_parts.shape[1]):
-        epid_rmv_parts2[:,j,:] = remove_small_objects(epid2[:,j,:], min_size=200)
-    # Write an array of just the removed particles, again
-    epid_parts2 = epid ^ epid_rmv_parts2
-    # Replace the small connected epidermal particles (< 800 px^2) with BG value
-    img[epid_parts2==1] = background
-    # Free up some memory
-    del epid_rmv_parts
-    del epid_rmv_parts2
-    del epid
+    # Keep epidermal particles >= 800 px^2 in each transverse slice, then those >= 200 px^2 in the other dimension
+    epid_rmv_parts = keep_epidermis_xz(keep_epidermis_xy(epid))
+    # Replace the removed epidermal particles with BG value
+    img[epid & ~epid_rmv_parts] = background
     return img
 
-def dbl_pct_filt(arr):
+def _InitPostProcessWorker(in_filename, keep_path, values, out_filename=None):
+    # Runs once in each post-processing worker: open the input stack lazily, the shared epidermis mask and,
+    # when writing a chunked volume store, the output
+    global _postprocess_worker
+    _postprocess_worker = {"stack": LoadStackLazy(in_filename),
+                           "keep": np.load(keep_path, mmap_mode="r+"),
+                           "values": values,
+                           "out": None if out_filename is None else volume_store.open_volume(out_filename)}
+
+def _KeepEpidermisSlab(slab):
+    # First pass of delete_dangling_epidermis over a slab of transverse slices
+    z0, z1 = slab
+    epidermis = _postprocess_worker["values"][0]
+    keep = _postprocess_worker["keep"]
+    keep[z0:z1] = keep_epidermis_xy(np.asarray(_postprocess_worker["stack"][z0:z1])==epidermis)
+    keep.flush()
+    return z1-z0
+
+def _KeepEpidermisRows(rows):
+    # Second pass of delete_dangling_epidermis over a block of (z, x) slices; needs the whole stack depth
+    j0, j1 = rows
+    keep = _postprocess_worker["keep"]
+    keep[:,j0:j1,:] = keep_epidermis_xz(np.array(keep[:,j0:j1,:]))
+    keep.flush()
+    return j1-j0
+
+def _PostProcessSlab(slab):
+    # Post-process a slab of transverse slices, read with postprocess_halo slices of context on each side
+    z0, z1 = slab
+    epidermis, background, spongy, palisade, ias, vein = _postprocess_worker["values"]
+    stack = _postprocess_worker["stack"]
+    h0 = max(z0-postprocess_halo, 0)
+    h1 = min(z1+postprocess_halo, stack.shape[0])
+    img = np.array(stack[h0:h1])
+    img[(img==epidermis) & ~_postprocess_worker["keep"][h0:h1]] = background
+    img = smooth_epidermis(img,epidermis,background,spongy,palisade,ias,vein)
+    img = final_smooth(img,vein,spongy,palisade,epidermis,ias,background)
+    return img[z0-h0:z1-h0]
+
+def _PostProcessSlabToVolume(slab):
+    # Post-process a slab and write it straight into the output volume store; slabs cover whole chunks,
+    # so workers write concurrently without touching each other's chunks
+    z0, z1 = slab
+    _postprocess_worker["out"][z0:z1] = img_as_ubyte(_PostProcessSlab(slab))
+    return z1-z0
+
+def PostProcessStack(in_filename, out_filename, epidermis, background, spongy, palisade, ias, vein, n_workers=None, tmp_dir=None):
+    # Run delete_dangling_epidermis, smooth_epidermis and final_smooth out-of-core on slabs of transverse slices
+    # and save the result as 8-bit: written by the workers into a chunked volume store when out_filename is one
+    # (see StackPath), otherwise appended to a tif as slabs finish; memory scales with postprocess_slab_size.
+    # Only the (z, x) pass of delete_dangling_epidermis needs the whole stack depth, so its mask is shared
+    # through a memory-mapped file; the rest is exact on slabs with a halo (see postprocess_halo)
+    global _postprocess_worker
+    if n_workers is None:
+        n_workers = postprocess_workers
+    shape = LoadStackLazy(in_filename).shape
+    slabs = [(z,min(z+postprocess_slab_size,shape[0])) for z in range(0,shape[0],postprocess_slab_size)]
+    row_blocks = [(j,min(j+postprocess_slab_size,shape[1])) for j in range(0,shape[1],postprocess_slab_size)]
+    shared_dir = tempfile.mkdtemp(prefix="PostProcessStack_", dir=tmp_dir)
+    pool = None
+    try:
+        keep_path = os.path.join(shared_dir, "epidermis_keep.npy")
+        np.lib.format.open_memmap(keep_path, mode="w+", dtype=bool, shape=shape).flush()
+        values = (epidermis, background, spongy, palisade, ias, vein)
+        to_volume = not out_filename.lower().endswith((".tif", ".tiff"))
+        if to_volume:
+            # Chunks no deeper than a slab and aligned with slabs
+            depth = volume_store.chunk_shape[0]
+            if postprocess_slab_size % depth:
+                depth = postprocess_slab_size
+            volume_store.create_volume(out_filename, shape, np.uint8, (depth,)+tuple(volume_store.chunk_shape[1:]))
+        worker_out = out_filename if to_volume else None
+        if n_workers <= 1:
+            _InitPostProcessWorker(in_filename, keep_path, values, worker_out)
+            imap = lambda func, tasks: (func(task) for task in tasks)
+        else:
+            pool = multiprocessing.Pool(n_workers, initializer=_InitPostProcessWorker,
+                                        initargs=(in_filename,keep_path,values,worker_out))
+            imap = pool.imap
+        print("Removing dangling epidermis...")
+        with tqdm(total=shape[0]+shape[1]) as progress:
+            for n_done in imap(_KeepEpidermisSlab, slabs):
+                progress.update(n_done)
+            for n_done in imap(_KeepEpidermisRows, row_blocks):
+                progress.update(n_done)
+        print("Smoothing...")
+        if to_volume:
+            with tqdm(total=shape[0]) as progress:
+                for n_done in imap(_PostProcessSlabToVolume, slabs):
+                    progress.update(n_done)
+        else:
+            with volume_store.SliceWriter(out_filename, shape, np.uint8) as writer, tqdm(total=shape[0]) as progress:
+                for processed_slab in imap(_PostProcessSlab, slabs):
+                    for processed_slice in processed_slab:
+                        writer.write(img_as_ubyte(processed_slice))
+                    progress.update(len(processed_slab))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _postprocess_worker = None
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+def binary_rank_filter1d(mask, size, rank, axis=-1):
+    # Rank filter of a boolean mask along one axis, equal to scipy's rank_filter (mode 'reflect'): the rank-th
+    # smallest value of a window is True when the window holds at least size-rank True values.
+    # Window means are multiples of 1/size, so comparing against a half-step threshold is exact
+    means = spim.uniform_filter1d(mask.astype(np.float32), size, axis=axis, output=np.float32, mode="reflect")
+    return means > (size-rank-0.5)/size
+
+def dbl_pct_filt(arr, axis=-1):
     # Define percentile filter for clipping off artefactual IAS protrusions due to dangling epidermis
-    out = percentile_filter(percentile_filter(arr,size=30,percentile=10),size=30,percentile=90)
+    # Filters along one axis; on boolean masks the percentiles reduce to counting True values in each window
+    if arr.dtype == bool:
+        out = binary_rank_filter1d(binary_rank_filter1d(arr,30,int(30*10/100.0),axis),30,int(30*90/100.0),axis)
+    else:
+        size = [1]*arr.ndim
+        size[axis] = 30
+        out = percentile_filter(percentile_filter(arr,size=size,percentile=10),size=size,percentile=90)
     return out
 
 def min_max_filt(arr):
     # Define minimmum and maximum filters for clipping off artefactual IAS protrusions due to dangling epidermis
     # FIX: Perhaps make this variable? User input based?
-    out = minimum_filter(maximum_filter(arr,20),20)
+    if arr.dtype == bool:
+        # Box maximum and minimum filters of a boolean mask, one axis at a time
+        out = arr
+        for axis in range(arr.ndim):
+            out = binary_rank_filter1d(out,20,19,axis)
+        for axis in range(arr.ndim):
+            out = binary_rank_filter1d(out,20,0,axis)
+    else:
+        out = minimum_filter(maximum_filter(arr,20),20)
     return out
 
 def check_array_orient(arr1,arr2):
@@ -341,80 +404,735 @@ def check_array_orient(arr1,arr2):
                 arr1_obs = [0,2,1]
             else:
                 arr1_obs = [0,1,2]
-        out = np.moveaxis(arr2, source=arr1_obs, destination=[0,1,2])
+        # Permute the axes without copying; lazily loaded stacks stay lazy (see VolumeView)
+        if isinstance(arr2, np.ndarray):
+            out = np.moveaxis(arr2, source=arr1_obs, destination=[0,1,2])
+        else:
+            out = VolumeView(arr2, arr1_obs)
     else:
-        out = np.copy(arr2)
+        out = arr2
     return out
 
 def winVar(img, wlen):
-    # Variance filter
+    # Variance filter; accumulated in float64 to avoid cancellation in E[x^2]-E[x]^2, returned in the input dtype
+    img64 = img.astype(np.float64)
     wmean, wsqrmean = (cv2.boxFilter(x,-1,(wlen,wlen), borderType=cv2.BORDER_REFLECT)
-                       for x in (img, img*img))
-    return wsqrmean - wmean*wmean
+                       for x in (img64, img64*img64))
+    return (wsqrmean - wmean*wmean).astype(img.dtype)
 
-def RFPredictCTStack(rf_transverse,gridimg_in, phaseimg_in, localthick_cellvein_in, section):
-    # Use random forest model to predict entire CT stack on a slice-by-slice basis
-    global dist_edge_FL
-    dist_edge_FL = []
-    # Define distance from lower/upper image boundary
-    dist_edge = np.ones(gridimg_in.shape, dtype=np.float64)
-    dist_edge[:,(0,1,2,3,4,gridimg_in.shape[1]-4,gridimg_in.shape[1]-3,gridimg_in.shape[1]-2,gridimg_in.shape[1]-1),:] = 0
-    dist_edge = transform.rescale(dist_edge, 0.25)
-    dist_edge_FL = spim.distance_transform_edt(dist_edge)
-    dist_edge_FL = np.multiply(transform.rescale(dist_edge_FL,4),4)
-    if dist_edge_FL.shape[1]>gridimg_in.shape[1]:
-        dist_edge_FL = dist_edge_FL[:,0:gridimg_in.shape[1],:]
-    # Define numpy array for storing class predictions
-    RFPredictCTStack_out = np.empty(gridimg_in.shape, dtype=np.float64)
-    # Define empty numpy array for feature layers (FL)
-    FL = np.empty((gridimg_in.shape[1],gridimg_in.shape[2],num_feature_layers), dtype=np.float64)
-    for j in tqdm(range(0,gridimg_in.shape[0])):
-        # Populate FL array with feature layers using custom filters, etc.
-        FL[:,:,0] = gridimg_in[j,:,:]
-        FL[:,:,1] = phaseimg_in[j,:,:]
-        FL[:,:,2] = gaussian(FL[:,:,0],8)
-        FL[:,:,3] = gaussian(FL[:,:,1],8)
-        FL[:,:,4] = gaussian(FL[:,:,0],64)
-        FL[:,:,5] = gaussian(FL[:,:,1],64)
-        FL[:,:,6] = winVar(FL[:,:,0],9)
-        FL[:,:,7] = winVar(FL[:,:,1],9)
-        FL[:,:,8] = winVar(FL[:,:,0],18)
-        FL[:,:,9] = winVar(FL[:,:,1],18)
-        FL[:,:,10] = winVar(FL[:,:,0],36)
-        FL[:,:,11] = winVar(FL[:,:,1],36)
-        FL[:,:,12] = winVar(FL[:,:,0],72)
-        FL[:,:,13] = winVar(FL[:,:,1],72)
-        FL[:,:,14] = LoadCTStack(localthick_cellvein_in,j,section)[:,:]
-        FL[:,:,15] = dist_edge_FL[j,:,:]
-        FL[:,:,16] = gaussian(FL[:,:,0],4)
-        FL[:,:,17] = gaussian(FL[:,:,1],4)
-        FL[:,:,18] = gaussian(FL[:,:,0],32)
-        FL[:,:,19] = gaussian(FL[:,:,1],32)
-        FL[:,:,20] = sobel(FL[:,:,0])
-        FL[:,:,21] = sobel(FL[:,:,1])
-        FL[:,:,22] = gaussian(FL[:,:,20],8)
-        FL[:,:,23] = gaussian(FL[:,:,21],8)
-        FL[:,:,24] = gaussian(FL[:,:,20],32)
-        FL[:,:,25] = gaussian(FL[:,:,21],32)
-        FL[:,:,26] = gaussian(FL[:,:,20],64)
-        FL[:,:,27] = gaussian(FL[:,:,21],64)
-        FL[:,:,28] = gaussian(FL[:,:,20],128)
-        FL[:,:,29] = gaussian(FL[:,:,21],128)
-        FL[:,:,30] = winVar(FL[:,:,20],32)
-        FL[:,:,31] = winVar(FL[:,:,21],32)
-        FL[:,:,32] = winVar(FL[:,:,20],64)
-        FL[:,:,33] = winVar(FL[:,:,21],64)
-        FL[:,:,34] = winVar(FL[:,:,20],128)
-        FL[:,:,35] = winVar(FL[:,:,21],128)
+def gaussBlur(img, sd):
+    # Gaussian filter matching skimage's gaussian (truncate=4, 'nearest' borders), but using OpenCV's separable filter
+    ksize = 2*int(4.0*sd+0.5)+1
+    return cv2.GaussianBlur(img, (ksize,ksize), sd, borderType=cv2.BORDER_REPLICATE)
+
+def gaussPyramidBlur(pyramid, sd):
+    # Large-sd gaussian filter evaluated on a gaussian pyramid; pyramid[0] is the full resolution image and
+    # is extended in place, so all large-sd blurs of one source share the same downsampled levels.
+    # Level k carries a blur of variance (4**k-1)/3 px^2, the remainder is applied at level k then upsampled.
+    level = 0
+    while (min(pyramid[0].shape) >= 16*2**(level+1)
+           and sd**2-(4**(level+1)-1)/3.0 >= (2.0*2**(level+1))**2):
+        level = level + 1
+    while len(pyramid) <= level:
+        pyramid.append(cv2.pyrDown(pyramid[-1], borderType=cv2.BORDER_REPLICATE))
+    blurred = gaussBlur(pyramid[level], np.sqrt(sd**2-(4**level-1)/3.0)/2**level)
+    if level == 0:
+        return blurred
+    # Pixel i of level k sits at pixel i*2**k of the full resolution image
+    scale = np.float64([[1.0/2**level,0,0],[0,1.0/2**level,0]])
+    return cv2.warpAffine(blurred, scale, (pyramid[0].shape[1],pyramid[0].shape[0]),
+                          flags=cv2.INTER_LINEAR|cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+
+def FeatureSource(name, sources):
+    # Return a feature bank source, deriving Sobel maps and the 3-slice local thickness minimum on first use
+    if name not in sources:
+        if name.startswith("sobel_"):
+            sources[name] = sobel(FeatureSource(name[len("sobel_"):], sources))
+        elif name == "localthick_min3":
+            sources[name] = np.min(sources["localthick_slab"], axis=0)
+    return sources[name]
+
+def FeatureLayerSlice(grid_slice, phase_slice, localthick_slab, dist_edge_slice, out=None):
+    # Populate the feature layers of one slice from the feature bank
+    # localthick_slab holds local thickness of the previous, current and next slice (see LocalThickSlab)
+    if out is None:
+        out = np.empty((grid_slice.shape[0],grid_slice.shape[1],num_feature_layers), dtype=feature_dtype)
+    sources = {"grid": np.ascontiguousarray(grid_slice, dtype=out.dtype),
+               "phase": np.ascontiguousarray(phase_slice, dtype=out.dtype),
+               "localthick_slab": localthick_slab,
+               "localthick": localthick_slab[1,:,:],
+               "dist_edge": dist_edge_slice}
+    pyramids = {}
+    for k, (filt, source, param) in enumerate(feature_bank):
+        img = FeatureSource(source, sources)
+        if filt == "raw":
+            out[:,:,k] = img
+        elif filt == "gaussian" and param >= gauss_pyramid_min_sd:
+            out[:,:,k] = gaussPyramidBlur(pyramids.setdefault(source, [img]), param)
+        elif filt == "gaussian":
+            out[:,:,k] = gaussBlur(img, param)
+        elif filt == "variance":
+            out[:,:,k] = winVar(img, param)
+        else:
+            raise ValueError("Unknown feature bank filter: "+str(filt))
+    return out
+
+def FeatureCacheKey(*arrays):
+    # Content hash of the inputs of a feature slice together with the feature definitions
+    key = hashlib.sha1(repr((feature_bank_version, feature_bank, gauss_pyramid_min_sd, np.dtype(feature_dtype).str)).encode())
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        key.update(repr((arr.dtype.str, arr.shape)).encode())
+        key.update(arr.data)
+    return key.hexdigest()
+
+def CachedFeatureLayerSlice(grid_slice, phase_slice, localthick_slab, dist_edge_slice, out=None):
+    # FeatureLayerSlice, reusing the feature layers saved in feature_cache_dir when the inputs are unchanged
+    if feature_cache_dir is None:
+        return FeatureLayerSlice(grid_slice, phase_slice, localthick_slab, dist_edge_slice, out=out)
+    path = os.path.join(feature_cache_dir, FeatureCacheKey(grid_slice, phase_slice, localthick_slab, dist_edge_slice)+".npy")
+    if os.path.exists(path):
+        if out is None:
+            return np.load(path)
+        out[...] = np.load(path)
+        return out
+    out = FeatureLayerSlice(grid_slice, phase_slice, localthick_slab, dist_edge_slice, out=out)
+    if not os.path.isdir(feature_cache_dir):
+        os.makedirs(feature_cache_dir)
+    # Write under a temporary name first so a half-written file is never read back
+    tmp_path = path+".{}.tmp".format(os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, out)
+    os.rename(tmp_path, path)
+    return out
+
+def LocalThickSlab(localthick_in,j,section):
+    # Local thickness of slice j and its neighbours in the chosen section; edge slices are repeated
+    # Indexed through a SectionView, so only these three slices are read from lazily loaded stacks (see LoadStackLazy)
+    localthick_view = SectionView(localthick_in,section)
+    return localthick_view[[max(j-1,0),j,min(j+1,localthick_view.shape[0]-1)],:,:]
+
+def DistEdgeFL(stack_shape):
+    # Define distance from lower/upper image boundary, i.e. from the 5 outermost rows at either edge
+    # Depends only on the row index, so one row profile is broadcast to stack_shape without allocating a volume
+    rows = np.arange(stack_shape[1], dtype=feature_dtype)
+    dist_edge_rows = np.maximum(np.minimum(rows-4, stack_shape[1]-5-rows), 0)
+    return np.broadcast_to(dist_edge_rows[np.newaxis,:,np.newaxis], stack_shape)
+
+@jit(nopython=True, cache=True)
+def _forest_proba(X, roots, depths, feature, threshold, left, right, value, branchless_depth, out):
+    # Add each tree's leaf class probabilities for every row of X to out; trees in order, as scikit-learn sums them.
+    # Nodes are in depth-first order, so a node's left child directly follows it. Leaves have threshold -inf and
+    # are their own left and right child, so stepping from a leaf stays there
+    block = 8
+    current = np.empty(block, dtype=np.int64)
+    for t in range(roots.shape[0]):
+        if depths[t] <= branchless_depth:
+            # Shallow trees: step a block of rows together for a fixed number of levels without branching,
+            # so the memory accesses of the rows overlap
+            for i0 in range(0, X.shape[0], block):
+                n = min(block, X.shape[0]-i0)
+                for k in range(n):
+                    current[k] = roots[t]
+                for level in range(depths[t]):
+                    for k in range(n):
+                        node = current[k]
+                        left_child = left[node]
+                        right_child = right[node]
+                        current[k] = left_child if X[i0+k,feature[node]] <= threshold[node] else right_child
+                for k in range(n):
+                    for c in range(value.shape[1]):
+                        out[i0+k,c] += value[current[k],c]
+        else:
+            # Deep trees: walk each row down to its leaf
+            for i in range(X.shape[0]):
+                node = roots[t]
+                while threshold[node] != -np.inf:
+                    if X[i,feature[node]] <= threshold[node]:
+                        node = node+1
+                    else:
+                        node = right[node]
+                for c in range(value.shape[1]):
+                    out[i,c] += value[node,c]
+
+def _preorder(children_left, children_right):
+    # Node ids of a tree in depth-first order, left subtree first
+    order = []
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        if children_left[node] != -1:
+            stack.append(children_right[node])
+            stack.append(children_left[node])
+    return np.array(order, dtype=np.int64)
+
+class CompiledForest(object):
+    # Fitted random forest flattened into node arrays of all trees and evaluated with a compiled traversal
+    # (see _forest_proba); predictions match the forest's own predict/predict_proba
+    def __init__(self, forest):
+        roots, depths, feature, threshold, left_child, right, value = [], [], [], [], [], [], []
+        offset = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            left = tree.children_left
+            internal = np.flatnonzero(left != -1)
+            # Trees are usually built depth-first already; best-first trees (max_leaf_nodes) are renumbered
+            if np.array_equal(left[internal], internal+1):
+                order = np.arange(tree.node_count)
+            else:
+                order = _preorder(left, tree.children_right)
+            rank = np.empty(tree.node_count, dtype=np.int64)
+            rank[order] = np.arange(tree.node_count)
+            is_leaf = left[order] == -1
+            roots.append(offset)
+            depths.append(tree.max_depth)
+            feature.append(np.where(is_leaf, 0, tree.feature[order]))
+            threshold.append(np.where(is_leaf, -np.inf, tree.threshold[order]))
+            left_child.append(np.where(is_leaf, np.arange(tree.node_count), np.arange(1,tree.node_count+1))+offset)
+            right.append(np.where(is_leaf, np.arange(tree.node_count), rank[tree.children_right[order]])+offset)
+            value.append(tree.value[order,0,:forest.n_classes_])
+            offset = offset+tree.node_count
+        self.roots = np.array(roots, dtype=np.int64)
+        self.depths = np.array(depths, dtype=np.int64)
+        self.feature = np.concatenate(feature).astype(np.int64)
+        self.threshold = np.concatenate(threshold).astype(np.float64)
+        self.left = np.concatenate(left_child).astype(np.int64)
+        self.right = np.concatenate(right).astype(np.int64)
+        # Class probabilities of each leaf; scikit-learn >= 1.4 stores them, older versions store class counts
+        # that DecisionTreeClassifier.predict_proba normalizes
+        value = np.concatenate(value).astype(np.float64)
+        if tuple(int(v) for v in skl.__version__.split(".")[:2]) < (1,4):
+            normalizer = value.sum(axis=1)[:,np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value = value/normalizer
+        self.value = value
+        self.classes_ = forest.classes_
+        self.n_estimators = len(forest.estimators_)
+
+    def predict_proba(self, X):
+        # scikit-learn's trees compare float32 features against float64 thresholds
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        proba = np.zeros((X.shape[0],self.value.shape[1]), dtype=np.float64)
+        _forest_proba(X, self.roots, self.depths, self.feature, self.threshold, self.left, self.right, self.value,
+                      forest_branchless_depth, proba)
+        proba /= self.n_estimators
+        return proba
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+def compile_model(model):
+    # CompiledForest of a fitted random forest when compiled_inference is set, otherwise the model itself
+    if compiled_inference and isinstance(model, RandomForestClassifier):
+        return CompiledForest(model)
+    return model
+
+def CoarseToFineSlice(rf_transverse,FL,coarse_step):
+    # Predict classes of a slice's feature layers FL (rows, columns, num_feature_layers) on a grid of every
+    # coarse_step-th pixel, spread each coarse prediction over its coarse_step x coarse_step block, then
+    # re-predict at full resolution the blocks next to a different class or below predict_refine_confidence.
+    # Returns the predicted slice and the mask of re-predicted pixels
+    offset = coarse_step//2
+    FL_coarse = FL[offset::coarse_step,offset::coarse_step,:]
+    coarse_shape = FL_coarse.shape[0:2]
+    proba = rf_transverse.predict_proba(FL_coarse.reshape((-1,FL.shape[2])))
+    coarse = np.argmax(proba, axis=1).reshape(coarse_shape)
+    # A class boundary between two coarse pixels lies in one of their blocks, so flag every block whose
+    # 3x3 coarse neighbourhood holds more than one class
+    unsure = np.max(proba, axis=1).reshape(coarse_shape) < predict_refine_confidence
+    unsure |= spim.maximum_filter(coarse, size=3, mode="nearest") != spim.minimum_filter(coarse, size=3, mode="nearest")
+    # Block of each full resolution pixel; pixels past the last coarse row/column join the last block
+    rows = np.minimum(np.arange(FL.shape[0])//coarse_step, coarse_shape[0]-1)
+    cols = np.minimum(np.arange(FL.shape[1])//coarse_step, coarse_shape[1]-1)
+    prediction = rf_transverse.classes_.take(coarse, axis=0)[np.ix_(rows,cols)]
+    refine = unsure[np.ix_(rows,cols)]
+    if np.any(refine):
+        prediction[refine] = rf_transverse.predict(FL[refine])
+    return prediction, refine
+
+def PredictionStoreDir(folder_name):
+    # Incremental prediction store of a results folder (see prediction_store_dir), None when disabled
+    if prediction_store_dir is None:
+        return None
+    return '../results/'+folder_name+'/'+prediction_store_dir
+
+def OpenPredictionStore(store_dir, rf_transverse):
+    # Store handle passed to PredictCTSlice: the store folder and the hash of the (uncompiled) model
+    if store_dir is None:
+        return None
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    return (store_dir, joblib.hash(rf_transverse))
+
+def PredictionStorePath(store, j, coarse_step, *arrays):
+    # File of slice j in the prediction store, named by a hash of the model, the prediction mode and the
+    # slice's feature inputs, so a slice predicted from another model or from changed inputs is stale
+    store_dir, model_key = store
+    key = hashlib.sha1(repr((model_key, coarse_step, predict_refine_confidence if coarse_step > 1 else None,
+                             FeatureCacheKey(*arrays))).encode()).hexdigest()
+    return os.path.join(store_dir, "{0:05d}.{1}.npy".format(j, key))
+
+def SavePredictionSlice(path, prediction):
+    # Save a predicted slice to the prediction store and drop stale versions of the same slice
+    # Write under a temporary name first so a slice interrupted mid-write is never read back
+    tmp_path = path+".{}.tmp".format(os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, prediction)
+    os.rename(tmp_path, path)
+    store_dir, name = os.path.split(path)
+    prefix = name.split(".")[0]+"."
+    for other in os.listdir(store_dir):
+        if other.startswith(prefix) and other.endswith(".npy") and other != name:
+            os.remove(os.path.join(store_dir, other))
+
+def PredictCTSlice(rf_transverse,gridimg_in,phaseimg_in,localthick_cellvein_in,dist_edge_FL,j,section,FL,coarse_step=1,store=None):
+    # Predict classes of slice j; FL is a (rows, columns, num_feature_layers) scratch array
+    # With coarse_step > 1 the slice is predicted coarse-to-fine (see CoarseToFineSlice)
+    # With a prediction store (see OpenPredictionStore) an up-to-date stored slice is loaded instead of predicted,
+    # and new predictions are saved to it
+    grid_slice = gridimg_in[j,:,:]
+    phase_slice = phaseimg_in[j,:,:]
+    localthick_slab = LocalThickSlab(localthick_cellvein_in,j,section)
+    if store is not None:
+        path = PredictionStorePath(store, j, coarse_step, grid_slice, phase_slice, localthick_slab, dist_edge_FL[j,:,:])
+        if os.path.exists(path):
+            return np.load(path)
+    # Populate FL array with feature layers from the shared feature bank
+    FeatureLayerSlice(grid_slice, phase_slice, localthick_slab, dist_edge_FL[j,:,:], out=FL)
+    if coarse_step > 1:
+        class_prediction_transverse = CoarseToFineSlice(rf_transverse,FL,coarse_step)[0]
+    else:
         # Collapse training data to two dimensions
         FL_reshape = FL.reshape((-1,FL.shape[2]), order="F")
-        class_prediction_transverse = rf_transverse.predict(FL_reshape)
-        RFPredictCTStack_out[j,:,:] = class_prediction_transverse.reshape((
+        class_prediction_transverse = rf_transverse.predict(FL_reshape).reshape((
             gridimg_in.shape[1],
             gridimg_in.shape[2]),
             order="F")
+    if store is not None:
+        SavePredictionSlice(path, class_prediction_transverse)
+    return class_prediction_transverse
+
+def _InitPredictWorker(rf_transverse,stack_paths,section,out_path,out_shape,coarse_step,store):
+    # Runs once in each prediction worker: keep the forest and open the shared memmapped stacks read-only
+    global _predict_worker
+    if hasattr(rf_transverse, "n_jobs"):
+        rf_transverse.n_jobs = 1 # parallelism comes from the worker processes, avoid oversubscribing cores
+    stacks = [np.load(path, mmap_mode="r") for path in stack_paths]
+    _predict_worker = {"rf": rf_transverse,
+                       "section": section,
+                       "coarse_step": coarse_step,
+                       "store": store,
+                       "stacks": stacks+[DistEdgeFL(stacks[0].shape)],
+                       "out": np.memmap(out_path, dtype=label_dtype, mode="r+", shape=out_shape)}
+
+def _PredictSliceBlock(slices):
+    # Predict a block of slices in a worker process and write them straight into the shared output
+    gridimg_in, phaseimg_in, localthick_cellvein_in, dist_edge_FL = _predict_worker["stacks"]
+    out = _predict_worker["out"]
+    FL = np.empty((gridimg_in.shape[1],gridimg_in.shape[2],num_feature_layers), dtype=feature_dtype)
+    for j in slices:
+        out[j,:,:] = PredictCTSlice(_predict_worker["rf"],gridimg_in,phaseimg_in,localthick_cellvein_in,
+                                    dist_edge_FL,j,_predict_worker["section"],FL,_predict_worker["coarse_step"],
+                                    _predict_worker["store"])
+    out.flush()
+    return len(slices)
+
+def RFPredictCTStack(rf_transverse,gridimg_in, phaseimg_in, localthick_cellvein_in, section, n_workers=None, tmp_dir=None, coarse_step=None, store_dir=None):
+    # Use random forest model to predict entire CT stack on a slice-by-slice basis
+    # With n_workers > 1 slices are sharded across a process pool (see predict_workers)
+    # With coarse_step > 1 slices are predicted coarse-to-fine (see predict_coarse_step)
+    # With a store_dir only slices missing from the prediction store or stale are predicted (see prediction_store_dir)
+    if n_workers is None:
+        n_workers = predict_workers
+    if coarse_step is None:
+        coarse_step = predict_coarse_step
+    store = OpenPredictionStore(store_dir, rf_transverse)
+    rf_transverse = compile_model(rf_transverse)
+    if n_workers <= 1:
+        dist_edge_FL = DistEdgeFL(gridimg_in.shape)
+        # Define numpy array for storing class predictions
+        RFPredictCTStack_out = np.empty(gridimg_in.shape, dtype=label_dtype)
+        # Define empty numpy array for feature layers (FL)
+        FL = np.empty((gridimg_in.shape[1],gridimg_in.shape[2],num_feature_layers), dtype=feature_dtype)
+        for j in tqdm(range(0,gridimg_in.shape[0])):
+            RFPredictCTStack_out[j,:,:] = PredictCTSlice(rf_transverse,gridimg_in,phaseimg_in,localthick_cellvein_in,
+                                                         dist_edge_FL,j,section,FL,coarse_step,store)
+        return(RFPredictCTStack_out)
+    # Share stacks with the workers through memory-mapped files instead of pickling them per task
+    shared_dir = tempfile.mkdtemp(prefix="RFPredictCTStack_", dir=tmp_dir)
+    try:
+        stack_paths = []
+        for name, stack in (("grid",gridimg_in),("phase",phaseimg_in),("localthick",localthick_cellvein_in)):
+            stack_paths.append(os.path.join(shared_dir, name+".npy"))
+            np.save(stack_paths[-1], stack)
+        out_path = os.path.join(shared_dir, "prediction.dat")
+        np.memmap(out_path, dtype=label_dtype, mode="w+", shape=gridimg_in.shape).flush()
+        blocks = [range(j,min(j+predict_block_size,gridimg_in.shape[0])) for j in range(0,gridimg_in.shape[0],predict_block_size)]
+        pool = multiprocessing.Pool(n_workers, initializer=_InitPredictWorker,
+                                    initargs=(rf_transverse,stack_paths,section,out_path,gridimg_in.shape,coarse_step,store))
+        try:
+            with tqdm(total=gridimg_in.shape[0]) as progress:
+                for n_done in pool.imap_unordered(_PredictSliceBlock, blocks):
+                    progress.update(n_done)
+        finally:
+            pool.close()
+            pool.join()
+        RFPredictCTStack_out = np.array(np.memmap(out_path, dtype=label_dtype, mode="r", shape=gridimg_in.shape))
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    return(RFPredictCTStack_out)
+
+def _InitEnsembleWorker(models, stacks, out_paths, classes):
+    # Runs once in each ensemble prediction worker: keep the section models and open the stacks (arrays, or
+    # memory-mapped .npy paths) and the shared per-section probability outputs
+    global _ensemble_worker
+    for model in models.values():
+        if hasattr(model, "n_jobs"):
+            model.n_jobs = 1
+    stacks = [np.load(stack, mmap_mode="r") if isinstance(stack, str) else stack for stack in stacks]
+    _ensemble_worker = {"models": models,
+                        "stacks": stacks,
+                        "classes": classes,
+                        "out": dict((section, np.memmap(path, dtype=np.uint8, mode="r+", shape=stacks[0].shape+(len(classes),)))
+                                    for section, path in out_paths.items())}
+
+def _PredictSectionBlock(task):
+    # Predict a block of planes of one section and write their class probabilities (scaled to 0-255) into
+    # that section's output, in stack orientation
+    section, planes = task
+    gridimg_in, phaseimg_in, localthick_cellvein_in = _ensemble_worker["stacks"]
+    model = _ensemble_worker["models"][section]
+    columns = np.searchsorted(_ensemble_worker["classes"], model.classes_)
+    grid_view = SectionView(gridimg_in, section)
+    phase_view = SectionView(phaseimg_in, section)
+    dist_edge_view = SectionView(DistEdgeFL(gridimg_in.shape), section)
+    out = SectionArrayView(_ensemble_worker["out"][section], section)
+    FL = np.empty((grid_view.shape[1],grid_view.shape[2],num_feature_layers), dtype=feature_dtype)
+    plane = np.empty((grid_view.shape[1],grid_view.shape[2],len(_ensemble_worker["classes"])), dtype=np.uint8)
+    for j in planes:
+        FeatureLayerSlice(grid_view[j,:,:], phase_view[j,:,:], LocalThickSlab(localthick_cellvein_in,j,section),
+                          dist_edge_view[j,:,:], out=FL)
+        proba = model.predict_proba(FL.reshape((-1,FL.shape[2])))
+        plane[...] = 0
+        plane[:,:,columns] = np.rint(proba*255).reshape((FL.shape[0],FL.shape[1],len(columns)))
+        out[j] = plane
+    _ensemble_worker["out"][section].flush()
+    return len(planes)
+
+def SectionClasses(models, sections=None):
+    # Classes predicted by RFPredictCTStackEnsemble: those of any of the section models
+    if sections is None:
+        sections = predict_sections
+    return np.unique(np.concatenate([models[section].classes_ for section in sections]))
+
+def RFPredictCTStackEnsemble(models, gridimg_in, phaseimg_in, localthick_cellvein_in, sections=None, n_workers=None, tmp_dir=None, section_predictions=None):
+    # Predict the stack along each section in sections (see predict_sections) with that section's model
+    # (see train_section_models), then predict each voxel's class from the average of the sections' probabilities
+    # The passes run concurrently: blocks of planes of all sections are interleaved over one pool of n_workers,
+    # which read the same memory-mapped stacks. Each section's probabilities are kept as 0-255 per class in a
+    # memory-mapped file (one byte per class and voxel) and fused slab by slab
+    # With a section_predictions dict, each section's own class predictions are stored in it too
+    if sections is None:
+        sections = predict_sections
+    if n_workers is None:
+        n_workers = predict_workers
+    models = dict((section, compile_model(models[section])) for section in sections)
+    classes = SectionClasses(models, sections)
+    shape = gridimg_in.shape
+    shared_dir = tempfile.mkdtemp(prefix="RFPredictCTStackEnsemble_", dir=tmp_dir)
+    pool = None
+    try:
+        out_paths = {}
+        for section in sections:
+            out_paths[section] = os.path.join(shared_dir, section+".dat")
+            np.memmap(out_paths[section], dtype=np.uint8, mode="w+", shape=shape+(len(classes),)).flush()
+        # Blocks of planes of every section, ordered by their position in their section so the passes advance together
+        tasks = []
+        for k, section in enumerate(sections):
+            n_planes = SectionView(gridimg_in, section).shape[0]
+            tasks += [(j/float(n_planes), k, (section, range(j,min(j+predict_block_size,n_planes))))
+                      for j in range(0,n_planes,predict_block_size)]
+        tasks = [task for position, k, task in sorted(tasks, key=lambda task: task[0:2])]
+        if n_workers <= 1:
+            _InitEnsembleWorker(models, (gridimg_in,phaseimg_in,localthick_cellvein_in), out_paths, classes)
+            imap = lambda func, tasks: (func(task) for task in tasks)
+        else:
+            # Share stacks with the workers through memory-mapped files instead of pickling them per task
+            stack_paths = []
+            for name, stack in (("grid",gridimg_in),("phase",phaseimg_in),("localthick",localthick_cellvein_in)):
+                stack_paths.append(os.path.join(shared_dir, name+".npy"))
+                np.save(stack_paths[-1], stack)
+            pool = multiprocessing.Pool(n_workers, initializer=_InitEnsembleWorker,
+                                        initargs=(models,stack_paths,out_paths,classes))
+            imap = pool.imap_unordered
+        with tqdm(total=sum(len(planes) for section, planes in tasks)) as progress:
+            for n_done in imap(_PredictSectionBlock, tasks):
+                progress.update(n_done)
+        # Fuse: the class with the highest summed probability over the sections
+        probabilities = [np.memmap(out_paths[section], dtype=np.uint8, mode="r", shape=shape+(len(classes),)) for section in sections]
+        RFPredictCTStack_out = np.empty(shape, dtype=label_dtype)
+        if section_predictions is not None:
+            for section in sections:
+                section_predictions[section] = np.empty(shape, dtype=label_dtype)
+        for z0 in range(0, shape[0], predict_block_size):
+            z1 = min(z0+predict_block_size, shape[0])
+            total = np.zeros((z1-z0,)+shape[1:]+(len(classes),), dtype=np.uint16)
+            for section, section_probabilities in zip(sections, probabilities):
+                slab = np.array(section_probabilities[z0:z1])
+                total += slab
+                if section_predictions is not None:
+                    section_predictions[section][z0:z1] = classes[slab.argmax(axis=3)]
+            RFPredictCTStack_out[z0:z1] = classes[total.argmax(axis=3)]
+        del probabilities
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(shared_dir, ignore_errors=True)
     return(RFPredictCTStack_out)
 
+class TiffPageStack(object):
+    # Read-only stack over a (e.g. compressed) multi-page tif that decodes only the pages indexed along axis 0
+    def __init__(self, filename, shape=None):
+        self.filename = filename
+        self._tif = tifffile.TiffFile(filename)
+        series = self._tif.series[0]
+        self.dtype = series.dtype
+        self.shape = tuple(series.shape) if shape is None else tuple(shape) # shape may crop the stack
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, index):
+        # Only the indexed pages are decoded; remaining indices are applied to the decoded slices
+        if not isinstance(index, tuple):
+            index = (index,)
+        pages = index[0]
+        if isinstance(pages, (int, np.integer)):
+            img = self._tif.asarray(key=int(pages), series=0)[0:self.shape[1],0:self.shape[2]]
+        else:
+            if isinstance(pages, slice):
+                pages = range(*pages.indices(self.shape[0]))
+            img = np.stack([self._tif.asarray(key=int(k), series=0) for k in pages])[:,0:self.shape[1],0:self.shape[2]]
+        return img[(slice(None),)*(img.ndim-2)+index[1:]]
+
+    def __getstate__(self):
+        # Reopen the file in worker processes instead of pickling the file handle
+        return {"filename": self.filename, "shape": self.shape}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"], state["shape"])
+
+# Section orientations as (axes, flips) of a VolumeView: view axis d is stack axis axes[d], reversed if flips[d]
+# Same as np.rot90(stack, k=1, axes=(0,2)) for paradermal and np.rot90(stack, k=1, axes=(1,0)) for longitudinal sections
+section_axes = {"transverse": ((0,1,2), (False,False,False)),
+                "paradermal": ((2,1,0), (True,False,False)),
+                "longitudinal": ((1,0,2), (False,True,False))}
+
+class VolumeView(object):
+    # Read-only view of a 3D stack with its axes permuted and optionally reversed, resolved by index arithmetic:
+    # indexing the view indexes the stack, so only the requested planes are read from memory-mapped, tif
+    # (see TiffPageStack) or chunked (see volume_store) stacks. shape crops the stack (in stack axes) first.
+    # At most one axis may be indexed with a list of indices
+    def __init__(self, stack, axes=(0,1,2), flips=(False,False,False), shape=None):
+        self.stack = stack
+        self.axes = tuple(axes)
+        self.flips = tuple(flips)
+        self.stack_shape = tuple(stack.shape) if shape is None else tuple(shape)
+        self.shape = tuple(self.stack_shape[axis] for axis in self.axes)
+        self.ndim = 3
+        self.dtype = stack.dtype
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index+(slice(None),)*(3-len(index))
+        stack_index = [None]*3
+        kept = []
+        for d, i in enumerate(index):
+            n = self.shape[d]
+            if isinstance(i, slice):
+                start, stop, step = i.indices(n)
+                if len(range(start, stop, step)) == 0:
+                    start, stop, step = 0, 0, 1
+                elif self.flips[d]:
+                    start, stop, step = n-1-start, n-1-stop, -step
+                i = slice(start, stop if stop >= 0 else None, step)
+                kept.append(d)
+            elif isinstance(i, (int, np.integer)):
+                if not -n <= i < n:
+                    raise IndexError("index {i} is out of bounds for axis {d} with size {n}".format(i=i, d=d, n=n))
+                i = int(i)%n
+                if self.flips[d]:
+                    i = n-1-i
+            else:
+                i = np.asarray(i)%n
+                if self.flips[d]:
+                    i = n-1-i
+                kept.append(d)
+            stack_index[self.axes[d]] = i
+        out = np.asarray(self.stack[tuple(stack_index)])
+        # Remaining axes come out in stack order; put them in view order
+        stack_order = sorted(self.axes[d] for d in kept)
+        order = [stack_order.index(self.axes[d]) for d in kept]
+        if order != sorted(order):
+            out = np.ascontiguousarray(np.transpose(out, order))
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+def SectionView(stack, section, shape=None):
+    # View of a (z, y, x) stack as slices of the chosen section along axis 0, without rotating the stack
+    axes, flips = section_axes[section]
+    return VolumeView(stack, axes, flips, shape)
+
+def SectionArrayView(arr, section):
+    # Writable numpy view of a (z, y, x, ...) array in the chosen section, as SectionView reads it; trailing axes are kept
+    axes, flips = section_axes[section]
+    view = np.transpose(arr, tuple(axes)+tuple(range(3, arr.ndim)))
+    return view[tuple(slice(None,None,-1) if flip else slice(None) for flip in flips)]
+
+def LoadStackLazy(filename, shape=None):
+    # Open a tif stack or chunked volume store without reading it: tifs are memory-mapped when the image data
+    # are uncompressed and contiguous, otherwise decoded page by page. Optionally crop to shape (see match_array_dim)
+    if volume_store.is_volume(filename):
+        return volume_store.open_volume(filename, shape)
+    try:
+        stack = tifffile.memmap(filename, mode="r")
+    except ValueError:
+        return TiffPageStack(filename, shape)
+    if shape is not None:
+        stack = stack[0:shape[0],0:shape[1],0:shape[2]]
+    return stack
+
+def PredictionToUbyte(prediction, n_classes):
+    # Spread predicted class indices over 0-255, as saved in 'fullstack_prediction.tif'
+    # Uses a lookup table so no float copy of the stack is made. n_classes is the model's number of classes
+    # (len(classes_)), not the number found in the prediction, so values are the same whichever classes occur
+    if prediction.size and prediction.max() >= n_classes:
+        raise ValueError("Prediction holds class {c} but the model has only {n} classes".format(c=prediction.max(), n=n_classes))
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[0:n_classes] = img_as_ubyte(np.arange(n_classes)/float(n_classes))
+    return lut[prediction]
+
+def _OpenStreamingStacks(stack_filenames, shape):
+    # Lazily open grid, phase and local thickness stacks, cropped to a common shape
+    stacks = [LoadStackLazy(filename, shape) for filename in stack_filenames]
+    stacks.append(DistEdgeFL(shape))
+    return stacks
+
+def PredictStreamingBlock(rf_transverse, stacks, slices, coarse_step=1, store=None):
+    # Predict a block of transverse slices from lazily loaded stacks
+    gridimg_in, phaseimg_in, localthick_cellvein_in, dist_edge_FL = stacks
+    FL = np.empty((gridimg_in.shape[1],gridimg_in.shape[2],num_feature_layers), dtype=feature_dtype)
+    return [PredictCTSlice(rf_transverse,gridimg_in,phaseimg_in,localthick_cellvein_in,dist_edge_FL,j,"transverse",FL,coarse_step,store)
+            for j in slices]
+
+def _InitStreamingWorker(rf_transverse, stack_filenames, shape, coarse_step, store):
+    # Runs once in each streaming prediction worker
+    global _predict_worker
+    if hasattr(rf_transverse, "n_jobs"):
+        rf_transverse.n_jobs = 1
+    _predict_worker = {"rf": rf_transverse,
+                       "stacks": _OpenStreamingStacks(stack_filenames, shape),
+                       "coarse_step": coarse_step,
+                       "store": store}
+
+def _PredictStreamingBlockWorker(slices):
+    return PredictStreamingBlock(_predict_worker["rf"], _predict_worker["stacks"], slices, _predict_worker["coarse_step"],
+                                 _predict_worker["store"])
+
+def RFPredictCTStackStreaming(rf_transverse, grid_filename, phase_filename, localthick_filename, out_filename, n_workers=None, coarse_step=None, store_dir=None):
+    # Predict the full (transverse) stack out-of-core: input stacks are read lazily, a few slices at a time,
+    # and predictions are appended to an 8-bit tif or chunked volume store (see StackPath) as they finish,
+    # so memory is bounded by a few slices
+    # With a store_dir up-to-date slices are read back from the prediction store instead of predicted
+    if n_workers is None:
+        n_workers = predict_workers
+    if coarse_step is None:
+        coarse_step = predict_coarse_step
+    store = OpenPredictionStore(store_dir, rf_transverse)
+    rf_transverse = compile_model(rf_transverse)
+    stack_filenames = (grid_filename, phase_filename, localthick_filename)
+    # Match array dimensions, as match_array_dim does for in-memory stacks
+    shape = tuple(np.min([LoadStackLazy(filename).shape for filename in stack_filenames], axis=0))
+    n_classes = len(rf_transverse.classes_)
+    blocks = [range(j,min(j+predict_block_size,shape[0])) for j in range(0,shape[0],predict_block_size)]
+    pool = None
+    if n_workers <= 1:
+        stacks = _OpenStreamingStacks(stack_filenames, shape)
+        predicted_blocks = (PredictStreamingBlock(rf_transverse, stacks, slices, coarse_step, store) for slices in blocks)
+    else:
+        pool = multiprocessing.Pool(n_workers, initializer=_InitStreamingWorker,
+                                    initargs=(rf_transverse,stack_filenames,shape,coarse_step,store))
+        predicted_blocks = pool.imap(_PredictStreamingBlockWorker, blocks)
+    try:
+        with volume_store.SliceWriter(out_filename, shape, np.uint8) as writer, tqdm(total=shape[0]) as progress:
+            for predicted_block in predicted_blocks:
+                for predicted_slice in predicted_block:
+                    writer.write(PredictionToUbyte(predicted_slice, n_classes))
+                progress.update(len(predicted_block))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def coarse_to_fine_report(rf_transverse,gridimg_in,phaseimg_in,localthick_cellvein_in,section,folder_name,steps=None,slices=None):
+    # Predict slices exhaustively and coarse-to-fine for each coarse step, and write prediction time, speedup,
+    # share of re-predicted pixels and agreement with the exhaustive prediction to 'CoarseToFine.txt'
+    # Feature layers are computed once per slice; their time is added to every mode
+    if steps is None:
+        steps = coarse_report_steps
+    if slices is None:
+        n_slices = gridimg_in.shape[0] if coarse_report_slices is None else min(coarse_report_slices, gridimg_in.shape[0])
+        slices = np.unique(np.linspace(0, gridimg_in.shape[0]-1, n_slices).astype(int))
+    rf_transverse = compile_model(rf_transverse)
+    dist_edge_FL = DistEdgeFL(gridimg_in.shape)
+    FL = np.empty((gridimg_in.shape[1],gridimg_in.shape[2],num_feature_layers), dtype=feature_dtype)
+    feature_time = 0.0
+    predict_time = np.zeros(len(steps)+1)
+    refined = np.zeros(len(steps)+1)
+    class_pixels = np.zeros(len(rf_transverse.classes_))
+    class_agree = np.zeros((len(steps)+1,len(rf_transverse.classes_)))
+    rf_transverse.predict(np.zeros((1,num_feature_layers), dtype=feature_dtype)) # compile/load before timing
+    for j in tqdm(slices):
+        start = time.time()
+        FeatureLayerSlice(gridimg_in[j,:,:], phaseimg_in[j,:,:],
+                          LocalThickSlab(localthick_cellvein_in,j,section), dist_edge_FL[j,:,:], out=FL)
+        feature_time += time.time()-start
+        start = time.time()
+        exhaustive = rf_transverse.predict(FL.reshape((-1,FL.shape[2]))).reshape(FL.shape[0:2])
+        predict_time[0] += time.time()-start
+        exhaustive_class = np.searchsorted(rf_transverse.classes_, exhaustive)
+        class_pixels += np.bincount(exhaustive_class.ravel(), minlength=len(class_pixels))
+        for i, step in enumerate(steps):
+            start = time.time()
+            prediction, refine = CoarseToFineSlice(rf_transverse,FL,step)
+            predict_time[i+1] += time.time()-start
+            refined[i+1] += np.count_nonzero(refine)
+            same = prediction == exhaustive
+            class_agree[i+1] += np.bincount(exhaustive_class[same], minlength=len(class_pixels))
+    n_pixels = class_pixels.sum()
+    refined[0] = n_pixels
+    class_agree[0] = class_pixels
+    rows = []
+    for i, step in enumerate([1]+list(steps)):
+        stack_time = feature_time+predict_time[i]
+        # Agreement of the worst class, relative to the pixels exhaustive prediction gives it
+        present = class_pixels > 0
+        rows.append(["exhaustive" if step == 1 else step, stack_time, (feature_time+predict_time[0])/stack_time,
+                     refined[i]/n_pixels*100, class_agree[i].sum()/n_pixels*100,
+                     np.min(class_agree[i][present]/class_pixels[present])*100])
+    table = tabulate(rows, headers=["Coarse step","Predict time (s)","Speedup","Re-predicted pixels (%)",
+                                    "Agreement (%)","Lowest class agreement (%)"], floatfmt=".2f")
+    table = "{0} of {1} slices, feature layers {2:.2f}s of each predict time\n".format(len(slices), gridimg_in.shape[0], feature_time)+table
+    print(table)
+    with open('../results/'+folder_name+'/CoarseToFine.txt', 'w') as report_file:
+        report_file.write(table+'\n')
+
 def check_images(prediction_prob_imgs,prediction_imgs,observed_imgs,FL_imgs,phaserec_stack,folder_name):
     # Plot images of class probabilities, predicted classes, observed classes, and feature layer of interest
     #SUPPRESS
@@ -486,17 +1204,22 @@ def make_normconf_matrix(L_test,class_p,folder_name):
 def predict_testset(rf_t,FL_test):
     # predict single slices from dataset
     print("***GENERATING PREDICTED STACK***")
+    rf_t = compile_model(rf_t)
     class_prediction = rf_t.predict(FL_test)
     class_prediction_prob = rf_t.predict_proba(FL_test)
     return class_prediction, class_prediction_prob
 
 def print_feature_layers(rf_t,folder_name):
-    # Print feature layer importance
+    # Print feature layer importance; only available for random forest backends
     file = open('../results/'+folder_name+'/FeatureLayer.txt','w')
-    file.write('Our OOB prediction of accuracy for is: {oob}%'.format(oob=rf_t.oob_score_ * 100)+'\n')
-    feature_layers = range(0,len(rf_t.feature_importances_))
-    for fl, imp in zip(feature_layers, rf_t.feature_importances_):
-        file.write('Feature_layer {fl} importance: {imp}'.format(fl=fl, imp=imp)+'\n')
+    if hasattr(rf_t, "oob_score_"):
+        file.write('Our OOB prediction of accuracy for is: {oob}%'.format(oob=rf_t.oob_score_ * 100)+'\n')
+    if hasattr(rf_t, "feature_importances_"):
+        feature_layers = range(0,len(rf_t.feature_importances_))
+        for fl, imp in zip(feature_layers, rf_t.feature_importances_):
+            file.write('Feature_layer {fl} importance: {imp}'.format(fl=fl, imp=imp)+'\n')
+    else:
+        file.write('Feature layer importance is not available for '+type(rf_t).__name__+'\n')
     file.close()
 
 def displayImages_displayDims(gr_s,pr_s,ls,lt_s,gp_train,gp_test,label_train,label_test):
@@ -522,181 +1245,105 @@ def displayImages_displayDims(gr_s,pr_s,ls,lt_s,gp_train,gp_test,label_train,lab
     print('Local thickness stack shape = ' + str(lt_s.shape))
 
 def LoadCTStack(gridimg_in,sub_slices,section):
-    # Define image dimensions
-    if(section=="transverse"):
-        img_dim1 = gridimg_in.shape[1]
-        img_dim2 = gridimg_in.shape[2]
-        num_slices = gridimg_in.shape[0]
-        rot_i = 1
-        rot_j = 2
-        num_rot = 0
-    if(section=="paradermal"):
-        img_dim1 = gridimg_in.shape[1]
-        img_dim2 = gridimg_in.shape[0]
-        num_slices = gridimg_in.shape[2]
-        rot_i = 0
-        rot_j = 2
-        num_rot = 1
-    if(section=="longitudinal"):
-        img_dim1 = gridimg_in.shape[0]
-        img_dim2 = gridimg_in.shape[2]
-        num_slices = gridimg_in.shape[1]
-        rot_i = 1
-        rot_j = 0
-        num_rot = 1
-    # Load training label data
-    labelimg_in_rot = np.rot90(gridimg_in, k=num_rot, axes=(rot_i,rot_j))
-    labelimg_in_rot_sub = labelimg_in_rot[sub_slices,:,:]
-    return(labelimg_in_rot_sub)
-
-def minFilter(img):
-    filtered = sp.ndimage.filters.minimum_filter(img, size = (3,1,1))
-    return filtered
+    # Slices sub_slices of the stack in the chosen section; only those slices are read (see SectionView)
+    return(SectionView(gridimg_in,section)[sub_slices,:,:])
 
 def GenerateFL2(gridimg_in,phaseimg_in,localthick_cellvein_in,sub_slices,section):
     # Generate feature layers based on grid/phase stacks and local thickness stack
-    if(section=="transverse"):
-        img_dim1 = gridimg_in.shape[1]
-        img_dim2 = gridimg_in.shape[2]
-        num_slices = gridimg_in.shape[0]
-        rot_i = 1
-        rot_j = 2
-        num_rot = 0
-    if(section=="paradermal"):
-        img_dim1 = gridimg_in.shape[1]
-        img_dim2 = gridimg_in.shape[0]
-        num_slices = gridimg_in.shape[2]
-        rot_i = 0
-        rot_j = 2
-        num_rot = 1
-    if(section=="longitudinal"):
-        img_dim1 = gridimg_in.shape[0]
-        img_dim2 = gridimg_in.shape[2]
-        num_slices = gridimg_in.shape[1]
-        rot_i = 1
-        rot_j = 0
-        num_rot = 1
+    # Stacks are viewed in the chosen section (see SectionView), so only the slices in sub_slices are read
     #match array dimensions again
-    gridimg_in, phaseimg_in = match_array_dim(gridimg_in,phaseimg_in)
-    # Rotate stacks to correct section view and select subset of slices
-    gridimg_in_rot = np.rot90(gridimg_in, k=num_rot, axes=(rot_i,rot_j))
-    phaseimg_in_rot = np.rot90(phaseimg_in, k=num_rot, axes=(rot_i,rot_j))
-    gridimg_in_rot_sub = gridimg_in_rot[sub_slices,:,:]
-    phaseimg_in_rot_sub = phaseimg_in_rot[sub_slices,:,:]
-    # Define distance from lower/upper image boundary
-    dist_edge = np.ones(gridimg_in.shape)
-    dist_edge[:,(0,1,2,3,4,gridimg_in.shape[1]-5,gridimg_in.shape[1]-4,gridimg_in.shape[1]-3,gridimg_in.shape[1]-2,gridimg_in.shape[1]-1),:] = 0
-    dist_edge = transform.rescale(dist_edge, 0.25,clip=True,preserve_range=True)
-    dist_edge_FL = spim.distance_transform_edt(dist_edge)
-    dist_edge_FL = np.multiply(transform.rescale(dist_edge_FL,4,clip=True,preserve_range=True),4)
-    if dist_edge_FL.shape[1]>gridimg_in.shape[1]:
-        dist_edge_FL = dist_edge_FL[:,0:gridimg_in.shape[1],:]
+    shape = tuple(np.minimum(gridimg_in.shape, phaseimg_in.shape))
+    gridimg_in_rot = SectionView(gridimg_in, section, shape)
+    phaseimg_in_rot = SectionView(phaseimg_in, section, shape)
+    # Distance from lower/upper image boundary, in the same section view
+    dist_edge_FL_rot = SectionView(DistEdgeFL(shape), section)
     # Define empty numpy array for feature layers (FL)
-    FL = np.empty((len(sub_slices),img_dim1,img_dim2,num_feature_layers), dtype=np.float64)
-    # Populate FL array with feature layers using custom filters, etc.
+    FL = np.empty((len(sub_slices),gridimg_in_rot.shape[1],gridimg_in_rot.shape[2],num_feature_layers), dtype=feature_dtype)
+    # Populate FL array with feature layers from the shared feature bank, or from the feature cache
     for i in tqdm(range(0,len(sub_slices))):
-        FL[i,:,:,0] = gridimg_in_rot_sub[i,:,:]
-        FL[i,:,:,1] = phaseimg_in_rot_sub[i,:,:]
-        FL[i,:,:,2] = gaussian(FL[i,:,:,0],8)
-        FL[i,:,:,3] = gaussian(FL[i,:,:,1],8)
-        FL[i,:,:,4] = gaussian(FL[i,:,:,0],64)
-        FL[i,:,:,5] = gaussian(FL[i,:,:,1],64)
-        FL[i,:,:,6] = winVar(FL[i,:,:,0],9)
-        FL[i,:,:,7] = winVar(FL[i,:,:,1],9)
-        FL[i,:,:,8] = winVar(FL[i,:,:,0],18)
-        FL[i,:,:,9] = winVar(FL[i,:,:,1],18)
-        FL[i,:,:,10] = winVar(FL[i,:,:,0],36)
-        FL[i,:,:,11] = winVar(FL[i,:,:,1],36)
-        FL[i,:,:,12] = winVar(FL[i,:,:,0],72)
-        FL[i,:,:,13] = winVar(FL[i,:,:,1],72)
-        FL[i,:,:,14] = LoadCTStack(localthick_cellvein_in, sub_slices, section)[i,:,:] # > 5%
-        FL[i,:,:,15] = dist_edge_FL[i,:,:]
-        FL[i,:,:,16] = gaussian(FL[i,:,:,0],4)
-        FL[i,:,:,17] = gaussian(FL[i,:,:,1],4)
-        FL[i,:,:,18] = gaussian(FL[i,:,:,0],32)
-        FL[i,:,:,19] = gaussian(FL[i,:,:,1],32)
-        FL[i,:,:,20] = sobel(FL[i,:,:,0])
-        FL[i,:,:,21] = sobel(FL[i,:,:,1])
-        FL[i,:,:,22] = gaussian(FL[i,:,:,20],8)
-        FL[i,:,:,23] = gaussian(FL[i,:,:,21],8)
-        FL[i,:,:,24] = gaussian(FL[i,:,:,20],32)
-        FL[i,:,:,25] = gaussian(FL[i,:,:,21],32)
-        FL[i,:,:,26] = gaussian(FL[i,:,:,20],64)
-        FL[i,:,:,27] = gaussian(FL[i,:,:,21],64)
-        FL[i,:,:,28] = gaussian(FL[i,:,:,20],128)
-        FL[i,:,:,29] = gaussian(FL[i,:,:,21],128)
-        FL[i,:,:,30] = winVar(FL[i,:,:,20],32)
-        FL[i,:,:,31] = winVar(FL[i,:,:,21],32)
-        FL[i,:,:,32] = winVar(FL[i,:,:,20],64)
-        FL[i,:,:,33] = winVar(FL[i,:,:,21],64)
-        FL[i,:,:,34] = winVar(FL[i,:,:,20],128)
-        FL[i,:,:,35] = winVar(FL[i,:,:,21],128)
-    FL[:,:,:,36] = minFilter(FL[:,:,:,14])
+        j = sub_slices[i]
+        CachedFeatureLayerSlice(gridimg_in_rot[j,:,:], phaseimg_in_rot[j,:,:],
+                                LocalThickSlab(localthick_cellvein_in,j,section), dist_edge_FL_rot[j,:,:], out=FL[i])
     # Collapse training data to two dimensions
     FL_reshape = FL.reshape((-1,FL.shape[3]), order="F")
     return FL_reshape
 
 def LoadLabelData(gridimg_in,sub_slices,section):
     # Load labeled data stack
-    # Define image dimensions
-    if(section=="transverse"):
-        img_dim1 = gridimg_in.shape[1]
-        img_dim2 = gridimg_in.shape[2]
-        num_slices = gridimg_in.shape[0]
-        rot_i = 1
-        rot_j = 2
-        num_rot = 0
-    if(section=="paradermal"):
-        img_dim1 = gridimg_in.shape[1]
-        img_dim2 = gridimg_in.shape[0]
-        num_slices = gridimg_in.shape[2]
-        rot_i = 0
-        rot_j = 2
-        num_rot = 1
-    if(section=="longitudinal"):
-        img_dim1 = gridimg_in.shape[0]
-        img_dim2 = gridimg_in.shape[2]
-        num_slices = gridimg_in.shape[1]
-        rot_i = 1
-        rot_j = 0
-        num_rot = 1
-    # Load training label data
-    labelimg_in_rot = np.rot90(gridimg_in, k=num_rot, axes=(rot_i,rot_j))
-    labelimg_in_rot_sub = labelimg_in_rot[sub_slices,:,:]
+    # Load training label data; only the slices in sub_slices are read (see SectionView)
+    labelimg_in_rot_sub = SectionView(gridimg_in,section)[sub_slices,:,:]
     # Collapse label data to a single dimension
     img_label_reshape = labelimg_in_rot_sub.ravel(order="F")
     # Encode labels as categorical variable
-    img_label_reshape = labenc.fit_transform(img_label_reshape)
+    img_label_reshape = labenc.fit_transform(img_label_reshape).astype(label_dtype)
     return(img_label_reshape)
 
+def load_artifact(folder_name, name, legacy_ext):
+    # Load a saved array or model: joblib files (uncompressed ones memory-mapped, so concurrent jobs share
+    # the pages), falling back to the .tif/.sav files written by older versions
+    filename = '../results/'+folder_name+'/'+name
+    if os.path.exists(filename+'.joblib'):
+        return joblib.load(filename+'.joblib', mmap_mode="r")
+    if legacy_ext == '.sav':
+        return pickle.load(open(filename+legacy_ext, 'rb'))
+    return io.imread(filename+legacy_ext)
+
 def load_trainmodel(folder_name):
     print("***LOADING TRAINED MODEL***")
     #load the model from disk
-    filename = '../results/'+folder_name+'/RF_model.sav'
-    rf = pickle.load(open(filename, 'rb'))
+    rf = load_artifact(folder_name,'RF_model','.sav')
     print("***LOADING FEATURE LAYER ARRAYS***")
-    FL_tr = io.imread('../results/'+folder_name+'/FL_train.tif')
-    FL_te = io.imread('../results/'+folder_name+'/FL_test.tif')
+    FL_tr = load_artifact(folder_name,'FL_train','.tif')
+    FL_te = load_artifact(folder_name,'FL_test','.tif')
     print("***LOADING LABEL IMAGE VECTORS***")
-    Label_tr = io.imread('../results/'+folder_name+'/Label_train.tif')
-    Label_te = io.imread('../results/'+folder_name+'/Label_test.tif')
+    Label_tr = load_artifact(folder_name,'Label_train','.tif')
+    Label_te = load_artifact(folder_name,'Label_test','.tif')
     return rf,FL_tr,FL_te,Label_tr,Label_te
 
 def save_trainmodel(rf_t,FL_train,FL_test,Label_train,Label_test,folder_name):
-    #Save model to disk; This can be a pretty large file -- ~2 Gb
+    #Save model to disk; This can be a pretty large file -- ~2 Gb (see artifact_compress)
     print("***SAVING TRAINED MODEL***")
-    filename = '../results/'+folder_name+'/RF_model.sav'
-    pickle.dump(rf_t, open(filename, 'wb'))
+    joblib.dump(rf_t, '../results/'+folder_name+'/RF_model.joblib', compress=artifact_compress)
+    # Section models (see save_section_models) belong to the previous model's training slices
+    for section in section_axes:
+        if os.path.exists('../results/'+folder_name+'/RF_model_'+section+'.joblib'):
+            os.remove('../results/'+folder_name+'/RF_model_'+section+'.joblib')
     print("***SAVING FEATURE LAYER ARRAYS***")
     #save training and testing feature layer array
-    #SUPPRESS
-    io.imsave('../results/'+folder_name+'/FL_train.tif',FL_train)
-    io.imsave('../results/'+folder_name+'/FL_test.tif',FL_test)
+    joblib.dump(FL_train, '../results/'+folder_name+'/FL_train.joblib', compress=artifact_compress)
+    joblib.dump(FL_test, '../results/'+folder_name+'/FL_test.joblib', compress=artifact_compress)
     print("***SAVING LABEL IMAGE VECTORS***")
     #save label image vectors
-    #SUPPRESS
-    io.imsave('../results/'+folder_name+'/Label_train.tif',Label_train)
-    io.imsave('../results/'+folder_name+'/Label_test.tif',Label_test)
+    joblib.dump(Label_train, '../results/'+folder_name+'/Label_train.joblib', compress=artifact_compress)
+    joblib.dump(Label_test, '../results/'+folder_name+'/Label_test.joblib', compress=artifact_compress)
+
+def sample_training_pixels(labels, max_per_class, seed=0):
+    # Indices of at most max_per_class pixels of each class. Pixels of a class are taken in the column-major (Fortran)
+    # order GenerateFL2/LoadLabelData flatten them in (slice fastest, then row, then column), and one is drawn at
+    # random from each of max_per_class equal runs; each run is a band of columns across all training slices, so the
+    # sample is spread over all training slices and image regions
+    rng = np.random.RandomState(seed)
+    sample = []
+    for c in np.unique(labels):
+        class_idx = np.flatnonzero(labels == c)
+        if max_per_class is None or len(class_idx) <= max_per_class:
+            sample.append(class_idx)
+        else:
+            step = len(class_idx)/float(max_per_class)
+            picks = (step*(np.arange(max_per_class)+rng.uniform(0,1,max_per_class))).astype(np.int64)
+            sample.append(class_idx[picks])
+    return np.sort(np.concatenate(sample))
+
+def new_classifier(backend=None, verbose=True):
+    # Untrained classifier from classifier_backends; random forests report out-of-bag accuracy
+    if backend is None:
+        backend = classifier_backend
+    if backend not in classifier_backends:
+        raise ValueError("Unknown classifier backend: "+str(backend))
+    classifier, params = classifier_backends[backend]
+    if classifier is None:
+        raise ValueError("Classifier backend "+backend+" is not available in this version of scikit-learn")
+    return classifier(verbose=int(verbose), **params)
 
 def train_model(gr_s,pr_s,ls,lt_s,gp_train,gp_test,label_train,label_test):
     print("***GENERATING FEATURE LAYERS***")
@@ -708,11 +1355,167 @@ def train_model(gr_s,pr_s,ls,lt_s,gp_train,gp_test,label_train,label_test):
     Label_train = LoadLabelData(ls, label_train, "transverse")
     Label_test = LoadLabelData(ls, label_test, "transverse")
     print("***TRAINING MODEL***\n(this step may take a few minutes...)")
-    # Define Random Forest classifier parameters and fit model
-    rf_trans = RandomForestClassifier(n_estimators=50, verbose=True, oob_score=True, n_jobs=-1, warm_start=False) #, class_weight="balanced")
-    rf_trans = rf_trans.fit(FL_train_transverse, Label_train)
+    # Define classifier (see classifier_backend) and fit model, on a per-class sample of pixels (see train_pixels_per_class)
+    rf_trans = new_classifier()
+    if train_pixels_per_class is None:
+        rf_trans = rf_trans.fit(FL_train_transverse, Label_train)
+    else:
+        sample = sample_training_pixels(Label_train, train_pixels_per_class)
+        print("Fitting on {n} of {total} training pixels".format(n=len(sample), total=len(Label_train)))
+        rf_trans = rf_trans.fit(FL_train_transverse[sample], Label_train[sample])
     return rf_trans,FL_train_transverse,FL_test_transverse, Label_train, Label_test
 
+def SectionTrainingData(gr_s,pr_s,ls,lt_s,gp_slices,label_slices,section,planes):
+    # Feature layers and encoded labels of the labeled pixels of some planes of a section: the pixels that lie in
+    # the labeled grid-phase slices gp_slices, labeled by the matching label_slices of ls. Labels are encoded as
+    # in train_model, so models of all sections share their classes
+    classes = np.unique(ls[label_slices])
+    label_index = np.full(gr_s.shape[0], -1, dtype=np.int64)
+    label_index[gp_slices] = np.arange(len(gp_slices))
+    # (z, y, x) stack coordinates of each pixel of a plane, viewed like the stacks
+    coords = [SectionView(np.broadcast_to(np.arange(n).reshape([-1 if a == axis else 1 for a in range(3)]), gr_s.shape), section)
+              for axis, n in enumerate(gr_s.shape)]
+    grid_view = SectionView(gr_s, section)
+    phase_view = SectionView(pr_s, section)
+    dist_edge_view = SectionView(DistEdgeFL(gr_s.shape), section)
+    FL = np.empty((grid_view.shape[1],grid_view.shape[2],num_feature_layers), dtype=feature_dtype)
+    FL_parts = []
+    label_parts = []
+    for j in tqdm(planes):
+        z = coords[0][j,:,:]
+        labeled = label_index[z] >= 0
+        if not labeled.any():
+            continue
+        CachedFeatureLayerSlice(grid_view[j,:,:], phase_view[j,:,:], LocalThickSlab(lt_s,j,section), dist_edge_view[j,:,:], out=FL)
+        FL_parts.append(FL[labeled])
+        # Position of each pixel's slice in gp_slices, mapped to the matching labeled slice of ls
+        label_stack_index = np.asarray(label_slices)[label_index[z[labeled]]]
+        labels = ls[label_stack_index, coords[1][j,:,:][labeled], coords[2][j,:,:][labeled]]
+        label_parts.append(np.searchsorted(classes, labels).astype(label_dtype))
+    return np.concatenate(FL_parts), np.concatenate(label_parts)
+
+def train_section_models(gr_s,pr_s,ls,lt_s,gp_train,label_train,models=None,sections=None):
+    # Fit a model for each section in sections (see predict_sections) for RFPredictCTStackEnsemble, keeping those
+    # already in models (e.g. the transverse model from train_model). Transverse models train on the labeled slices,
+    # paradermal and longitudinal models on section_train_planes evenly spaced planes, using their pixels that
+    # lie in the labeled slices
+    if sections is None:
+        sections = predict_sections
+    models = {} if models is None else dict(models)
+    for section in sections:
+        if section in models:
+            continue
+        if section == "transverse":
+            planes = gp_train
+        else:
+            n_planes = SectionView(gr_s, section).shape[0]
+            planes = np.unique(np.linspace(0, n_planes-1, section_train_planes).astype(int))
+        print("***GENERATING "+section.upper()+" FEATURE LAYERS***")
+        FL_section, Label_section = SectionTrainingData(gr_s,pr_s,ls,lt_s,gp_train,label_train,section,planes)
+        print("***TRAINING "+section.upper()+" MODEL***\n(this step may take a few minutes...)")
+        model = new_classifier()
+        if train_pixels_per_class is None:
+            models[section] = model.fit(FL_section, Label_section)
+        else:
+            sample = sample_training_pixels(Label_section, train_pixels_per_class)
+            print("Fitting on {n} of {total} training pixels".format(n=len(sample), total=len(Label_section)))
+            models[section] = model.fit(FL_section[sample], Label_section[sample])
+    return models
+
+def save_section_models(models, folder_name, gp_train, label_train):
+    # Save paradermal and longitudinal models as 'RF_model_<section>.joblib', each with the training slices it was
+    # fit on so load_section_models can tell when it is stale; the transverse model is 'RF_model.joblib' (see save_trainmodel)
+    for section, model in models.items():
+        if section != "transverse":
+            record = {"model": model, "gp_train": [int(i) for i in gp_train], "label_train": [int(i) for i in label_train]}
+            joblib.dump(record, '../results/'+folder_name+'/RF_model_'+section+'.joblib', compress=artifact_compress)
+
+def load_section_models(folder_name, gp_train, label_train, rf_transverse=None):
+    # Saved section models trained on gp_train/label_train, with rf_transverse as the transverse model. Models saved
+    # for other training slices (or without them) are left out, so section_models trains them again
+    models = {}
+    if rf_transverse is not None:
+        models["transverse"] = rf_transverse
+    for section in section_axes:
+        filename = '../results/'+folder_name+'/RF_model_'+section+'.joblib'
+        if section != "transverse" and os.path.exists(filename):
+            record = joblib.load(filename, mmap_mode="r")
+            if (isinstance(record, dict) and record.get("gp_train") == [int(i) for i in gp_train]
+                    and record.get("label_train") == [int(i) for i in label_train]):
+                models[section] = record["model"]
+            else:
+                print("Saved "+section+" model was trained on other slices; it will be trained again")
+    return models
+
+def section_models(rf_transverse,gr_s,pr_s,ls,lt_s,gp_train,label_train,folder_name,sections=None):
+    # Models for all sections in sections: saved ones trained on the same slices are loaded, others are trained and saved
+    if sections is None:
+        sections = predict_sections
+    models = load_section_models(folder_name, gp_train, label_train, rf_transverse)
+    if any(section not in models for section in sections):
+        models = train_section_models(gr_s,pr_s,ls,lt_s,gp_train,label_train,models,sections)
+        save_section_models(models, folder_name, gp_train, label_train)
+    return models
+
+def section_ensemble_report(models,gridimg_in,phaseimg_in,localthick_cellvein_in,ls,gp_train,gp_test,label_train,label_test,folder_name,sections=None):
+    # Predict the full stack with the transverse model alone (RFPredictCTStack) and with the section ensemble
+    # (RFPredictCTStackEnsemble), and write wall-clock time, accuracy on the labeled test slices and agreement with
+    # the transverse prediction of each, and of each section's model on its own, to 'SectionEnsemble.txt'
+    if sections is None:
+        sections = predict_sections
+    classes = np.unique(ls[label_train])
+    truth = ls[label_test]
+    # Test labels encoded as the predictions are; classes missing from the training slices can never be predicted
+    truth = np.where(np.isin(truth, classes), np.searchsorted(classes, truth), np.iinfo(label_dtype).max)
+    print("***PREDICTING FULL STACK (TRANSVERSE)***")
+    start = time.time()
+    transverse = RFPredictCTStack(models["transverse"],gridimg_in,phaseimg_in,localthick_cellvein_in,"transverse",coarse_step=1)
+    transverse_time = time.time()-start
+    print("***PREDICTING FULL STACK (SECTION ENSEMBLE)***")
+    predictions = {}
+    start = time.time()
+    fused = RFPredictCTStackEnsemble(models,gridimg_in,phaseimg_in,localthick_cellvein_in,sections,section_predictions=predictions)
+    ensemble_time = time.time()-start
+    accuracy = lambda prediction: np.mean(prediction[gp_test] == truth)*100
+    agreement = lambda prediction: np.mean(prediction == transverse)*100
+    rows = [["transverse (RFPredictCTStack)", transverse_time, 1.0, accuracy(transverse), 100.0]]
+    for section in sections:
+        rows.append([section+" model alone", None, None, accuracy(predictions[section]), agreement(predictions[section])])
+    rows.append(["ensemble: "+", ".join(sections), ensemble_time, ensemble_time/transverse_time, accuracy(fused), agreement(fused)])
+    table = tabulate(rows, headers=["Prediction","Wall-clock (s)","Time vs transverse","Test accuracy (%)","Agreement with transverse (%)"],
+                     floatfmt=".2f", missingval="-")
+    print(table)
+    with open('../results/'+folder_name+'/SectionEnsemble.txt', 'w') as report_file:
+        report_file.write(table+'\n')
+    return fused
+
+def training_budget_report(FL_train,Label_train,FL_test,Label_test,folder_name,budgets=None,backends=None):
+    # Fit a model per classifier backend and training sample budget (pixels per class) and write fit time,
+    # test set prediction time, OOB and test accuracy to 'TrainingBudget.txt' in the results folder
+    if budgets is None:
+        budgets = train_report_budgets
+    if backends is None:
+        backends = train_report_backends or [classifier_backend]
+    rows = []
+    for backend in backends:
+        for budget in budgets:
+            sample = sample_training_pixels(Label_train, budget)
+            model = new_classifier(backend, verbose=False)
+            start = time.time()
+            model.fit(FL_train[sample], Label_train[sample])
+            fit_time = time.time()-start
+            start = time.time()
+            class_prediction = model.predict(FL_test)
+            predict_time = time.time()-start
+            oob = getattr(model, "oob_score_", None)
+            rows.append([backend, "all" if budget is None else budget, len(sample), fit_time, predict_time,
+                         None if oob is None else oob*100, accuracy_score(Label_test, class_prediction)*100])
+    table = tabulate(rows, headers=["Backend","Pixels per class","Training pixels","Fit time (s)","Predict time (s)",
+                                    "OOB accuracy (%)","Test accuracy (%)"], floatfmt=".2f", missingval="-")
+    print(table)
+    with open('../results/'+folder_name+'/TrainingBudget.txt', 'w') as report_file:
+        report_file.write(table+'\n')
+
 def match_array_dim_label(stack1,stack2):
     #distinct match array dimensions function, to account for label_stack.shape[0]
     if stack1.shape[1]>stack2.shape[1]:
@@ -741,52 +1544,196 @@ def match_array_dim(stack1,stack2):
         stack2 = stack2[:,:,0:stack1.shape[2]]
     return stack1, stack2
 
+@jit(nopython=True, cache=True)
+def _dominated_spheres(radii):
+    # Flag voxels whose sphere lies inside the sphere of a neighbour q with at least the same radius,
+    # i.e. radii[q] >= radii[p] + |p-q|; painting those spheres cannot change the local thickness
+    nz, ny, nx = radii.shape
+    dominated = np.zeros(radii.shape, dtype=np.bool_)
+    for z in range(nz):
+        for y in range(ny):
+            for x in range(nx):
+                r = radii[z,y,x]
+                if r <= 0:
+                    continue
+                for dz in range(-1,2):
+                    for dy in range(-1,2):
+                        for dx in range(-1,2):
+                            zz = z+dz
+                            yy = y+dy
+                            xx = x+dx
+                            if (dz == 0 and dy == 0 and dx == 0) or zz < 0 or yy < 0 or xx < 0 or zz >= nz or yy >= ny or xx >= nx:
+                                continue
+                            if radii[zz,yy,xx] >= r+np.sqrt(dz*dz+dy*dy+dx*dx):
+                                dominated[z,y,x] = True
+    return dominated
+
+@jit(nopython=True, cache=True, fastmath=True)
+def _paint_spheres(out, centres, radii):
+    # Paint each sphere with its radius, keeping the largest radius covering every voxel
+    nz, ny, nx = out.shape
+    for n in range(centres.shape[0]):
+        z0 = centres[n,0]
+        y0 = centres[n,1]
+        x0 = centres[n,2]
+        r = radii[n]
+        ri = int(r)
+        for z in range(max(z0-ri,0), min(z0+ri+1,nz)):
+            for y in range(max(y0-ri,0), min(y0+ri+1,ny)):
+                rem = r*r-(z-z0)*(z-z0)-(y-y0)*(y-y0)
+                if rem < 0:
+                    continue
+                dx = int(np.sqrt(rem))
+                # guard against sqrt rounding, so the ball is exactly {|x-p|^2 <= r^2}
+                while (dx+1)*(dx+1) <= rem:
+                    dx = dx+1
+                while dx*dx > rem:
+                    dx = dx-1
+                for x in range(max(x0-dx,0), min(x0+dx+1,nx)):
+                    out[z,y,x] = max(out[z,y,x], r)
+
+@jit(nopython=True, cache=True)
+def _lower_envelope_1d(f, d, v, z):
+    # Squared distance transform of one line (Felzenszwalb & Huttenlocher): d[q] = min_p f[p]+(q-p)^2
+    # f holds integer squared distances (>= inf_sq for none); v, z are work buffers of length n, n+1
+    inf_sq = 2**30
+    n = f.shape[0]
+    k = -1
+    for q in range(n):
+        if f[q] >= inf_sq:
+            continue
+        if k < 0:
+            k = 0
+            v[0] = q
+            z[0] = -np.inf
+            z[1] = np.inf
+            continue
+        s = ((f[q]+q*q)-(f[v[k]]+v[k]*v[k]))/(2.0*(q-v[k]))
+        while s <= z[k]:
+            k = k-1
+            s = ((f[q]+q*q)-(f[v[k]]+v[k]*v[k]))/(2.0*(q-v[k]))
+        k = k+1
+        v[k] = q
+        z[k] = s
+        z[k+1] = np.inf
+    if k < 0:
+        for q in range(n):
+            d[q] = inf_sq
+        return
+    j = 0
+    for q in range(n):
+        while z[j+1] < q:
+            j = j+1
+        d[q] = min((q-v[j])*(q-v[j])+f[v[j]], inf_sq)
+
+@jit(nopython=True, cache=True)
+def _ball_dilation(centres, r):
+    # Voxels within Euclidean distance r of any centre (True in centres), via a separable squared distance transform
+    inf_sq = 2**30
+    nz, ny, nx = centres.shape
+    sq = np.empty((nz,ny,nx), dtype=np.int64)
+    n = max(nz,ny,nx)
+    f = np.empty(n, dtype=np.int64)
+    d = np.empty(n, dtype=np.int64)
+    v = np.empty(n, dtype=np.int64)
+    z = np.empty(n+1, dtype=np.float64)
+    for i in range(nz):
+        for j in range(ny):
+            for k in range(nx):
+                f[k] = 0 if centres[i,j,k] else inf_sq
+            _lower_envelope_1d(f[:nx], d[:nx], v, z)
+            for k in range(nx):
+                sq[i,j,k] = d[k]
+    for i in range(nz):
+        for k in range(nx):
+            for j in range(ny):
+                f[j] = sq[i,j,k]
+            _lower_envelope_1d(f[:ny], d[:ny], v, z)
+            for j in range(ny):
+                sq[i,j,k] = d[j]
+    covered = np.zeros((nz,ny,nx), dtype=np.bool_)
+    for j in range(ny):
+        for k in range(nx):
+            for i in range(nz):
+                f[i] = sq[i,j,k]
+            _lower_envelope_1d(f[:nz], d[:nz], v, z)
+            for i in range(nz):
+                covered[i,j,k] = d[i] <= r*r
+    return covered
+
 def local_thickness(im):
-    # Calculate local thickness; from Porespy library
-    if im.ndim == 2:
-        from skimage.morphology import square
-    dt = spim.distance_transform_edt(im)
-    sizes = sp.unique(sp.around(dt, decimals=0))
-    im_new = sp.zeros_like(im, dtype=float)
-    for r in tqdm(sizes):
-        im_temp = dt >= r
-        im_temp = spim.distance_transform_edt(~im_temp) <= r
-        im_new[im_temp] = r
-        #Trim outer edge of features to remove noise
+    # Calculate local thickness; as in the Porespy library, each voxel gets the largest radius r (rounded
+    # distance transform value) of a sphere that fits in the foreground and covers the voxel.
+    # Only spheres not contained in a neighbour's sphere are kept; for each radius those are either painted
+    # directly or, when there are many, dilated with one distance transform cropped to their bounding box.
+    im = np.asarray(im) != 0
+    im3d = im[np.newaxis] if im.ndim == 2 else im
+    dt = spim.distance_transform_edt(im3d)
+    sizes = np.unique(np.around(dt, decimals=0))
+    # Largest size r <= dt of each voxel
+    radii = sizes[np.searchsorted(sizes, dt, side="right")-1].astype(np.float32)
+    del dt
+    centres = np.argwhere((radii > 0) & ~_dominated_spheres(radii)).astype(np.int64)
+    centre_radii = radii[centres[:,0],centres[:,1],centres[:,2]]
+    del radii
+    order = np.argsort(centre_radii, kind="mergesort")
+    centres = centres[order]
+    centre_radii = centre_radii[order]
+    im_new = np.zeros(im3d.shape, dtype=np.float32)
+    r_values, r_starts = np.unique(centre_radii, return_index=True)
+    r_ends = np.append(r_starts[1:], len(centre_radii))
+    for r, start, end in tqdm(list(zip(r_values, r_starts, r_ends))):
+        pts = centres[start:end]
+        lo = np.maximum(pts.min(axis=0)-int(r), 0)
+        hi = np.minimum(pts.max(axis=0)+int(r)+1, im3d.shape)
+        # Painting costs ~4.2*r^3 voxel visits per sphere; a distance transform ~20 per voxel of the box
+        if len(pts)*4.2*r**3 <= 20*np.prod(hi-lo):
+            _paint_spheres(im_new, pts, centre_radii[start:end])
+        else:
+            is_centre = np.zeros(hi-lo, dtype=bool)
+            is_centre[tuple((pts-lo).T)] = True
+            covered = _ball_dilation(is_centre, int(r))
+            im_box = im_new[lo[0]:hi[0],lo[1]:hi[1],lo[2]:hi[2]]
+            im_box[covered & (im_box < r)] = r
+    im_new = im_new.reshape(im.shape)
+    #Trim outer edge of features to remove noise
     if im.ndim == 3:
         im_new = spim.binary_erosion(input=im, structure=ball(1))*im_new
     if im.ndim == 2:
-        im_new = spim.binary_erosion(input=im, structure=disc(1))*im_new
+        im_new = spim.binary_erosion(input=im, structure=disk(1))*im_new
     return im_new
 
 def localthick_up_save(folder_name):
     # run local thickness, upsample and save as a .tif stack in images folder
     print("***GENERATING LOCAL THICKNESS STACK***")
     #load thresholded binary downsampled images for local thickness
-    GridPhase_invert_ds = io.imread('../results/'+folder_name+'/GridPhase_invert_ds.tif')
+    GridPhase_invert_ds = LoadStack(StackPath(folder_name,'GridPhase_invert_ds'))
     #run local thickness
     local_thick = local_thickness(GridPhase_invert_ds)
     #upsample local_thickness images
-    local_thick_upscale = transform.rescale(local_thick, 4, mode='reflect')
+    if localthick_scale == 1:
+        local_thick_upscale = local_thick.astype(feature_dtype)
+    else:
+        local_thick_upscale = transform.rescale(local_thick.astype(feature_dtype), 1.0/localthick_scale, mode='reflect')
     print("***SAVING LOCAL THICKNESS STACK***")
-    #write as a .tif file in our images folder
-    io.imsave('../results/'+folder_name+'/local_thick_upscale.tif', local_thick_upscale)
+    #save in our results folder
+    SaveStack(StackPath(folder_name,'local_thick_upscale'), local_thick_upscale)
 
 def Threshold_GridPhase_invert_down(grid_img, phase_img, Th_grid, Th_phase,folder_name):
-    # Threshold grid and phase images and add the IAS together, invert, downsample and save as .tif stack
+    # Threshold grid and phase images and add the IAS together, invert, downsample and save (see StackPath)
     print("***THRESHOLDING IMAGES***")
-    tmp = np.zeros(grid_img.shape)
-    tmp[grid_img < Th_grid] = 1
-    tmp[grid_img >= Th_grid] = 0
-    tmp[phase_img < Th_phase] = 1
+    tmp = (grid_img < Th_grid) | (phase_img < Th_phase)
     #invert
     tmp_invert = invert(tmp)
-    #downsample to 25%
+    #downsample to localthick_scale (25% by default)
     #SUPPRESS
-    tmp_invert_ds = transform.rescale(tmp_invert, 0.25)
+    if localthick_scale == 1:
+        tmp_invert_ds = tmp_invert.astype(feature_dtype)
+    else:
+        tmp_invert_ds = transform.rescale(tmp_invert.astype(feature_dtype), localthick_scale)
     print("***SAVING IMAGE STACK***")
-    #write as a .tif file in custom results folder
-    io.imsave('../results/'+folder_name+'/GridPhase_invert_ds.tif',tmp_invert_ds)
+    #save in custom results folder
+    SaveStack(StackPath(folder_name,'GridPhase_invert_ds'), tmp_invert_ds)
 
 def openAndReadFile(filename):
     #opens and reads '.txt' file made by user with instructions for program...may execute full process n times
@@ -851,6 +1798,24 @@ def Load_images(fp,gr_name,pr_name,ls_name):
     label_stack = check_array_orient(gridrec_stack,label_stack)
     return gridrec_stack, phaserec_stack, label_stack
 
+def Load_images_lazy(fp,gr_name,pr_name,ls_name,localthick_filename):
+    # Open the gridrec, phaserec and local thickness stacks without reading them (see LoadStackLazy), cropped to
+    # common dimensions as match_array_dim and match_array_dim_label crop loaded stacks; slices are read as they
+    # are used. Only the label stack, which holds just the labeled slices, is read into memory
+    print("***OPENING IMAGE STACKS***")
+    label_stack = io.imread(fp + ls_name)
+    #FIX: Invert my label_stack, uncomment as needed
+    label_stack = invert(label_stack)
+    # Reorient label stack
+    label_stack = check_array_orient(LoadStackLazy(fp + gr_name),label_stack)
+    filenames = (fp + gr_name, fp + pr_name, localthick_filename)
+    shape = np.min([LoadStackLazy(filename).shape for filename in filenames], axis=0)
+    shape[1:] = np.minimum(shape[1:], label_stack.shape[1:])
+    label_stack = label_stack[:,0:shape[1],0:shape[2]]
+    shape = tuple(int(n) for n in shape)
+    gridrec_stack, phaserec_stack, localthick_stack = [LoadStackLazy(filename, shape) for filename in filenames]
+    return gridrec_stack, phaserec_stack, label_stack, localthick_stack
+
 def performance_metrics(stack,gp_test_slices,label_stack,label_test_slices,folder_name,tag):
     # generate absolute confusion matrix
     conf_matrix = pd.crosstab(stack[gp_test_slices,:,:].ravel(order="F"),label_stack[label_test_slices,:,].ravel(order="F"),rownames=['Actual'], colnames=['Predicted'])
@@ -874,72 +1839,81 @@ def performance_metrics(stack,gp_test_slices,label_stack,label_test_slices,folde
             metrics_file.write(tag+'\nAbsolute precision: {x}%'.format(x=total_accuracy*100)+'\n')
             metrics_file.close()
 
+def measure_leaf_traits(stack,epidermis,background,spongy,palisade,ias,vein,folder_name):
+    # Measure leaf traits of a post-processed stack (see leaf_traits.leaf_traits), write them to 'LeafTraits.txt'
+    # and the mesophyll and leaf thickness maps (pixels) to 'MesophyllThickness.tif' and 'LeafThickness.tif'
+    traits, mesophyll_thickness, leaf_thickness = leaf_traits.leaf_traits(stack,epidermis,background,spongy,palisade,ias,vein)
+    table = tabulate(traits, headers=["Trait","Pixels","Micrometres","Unit"], floatfmt=".4g", missingval="-")
+    print(table)
+    with open('../results/'+folder_name+'/LeafTraits.txt', 'w') as traits_file:
+        traits_file.write("Pixel size: {} um\n".format(leaf_traits.pixel_size)+table+'\n')
+    io.imsave('../results/'+folder_name+'/MesophyllThickness.tif', mesophyll_thickness.astype(np.float32))
+    io.imsave('../results/'+folder_name+'/LeafThickness.tif', leaf_thickness.astype(np.float32))
+
+def report_peak_memory(folder_name,tag):
+    # Append the peak resident memory of this process so far to 'MemoryUsage.txt' in the results folder
+    # Worker processes are not included; the resource module is not available on Windows
+    try:
+        import resource
+    except ImportError:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_gb = peak/1024.0**3 if sys.platform == "darwin" else peak/1024.0**2 # macOS reports bytes, Linux kB
+    print("Peak memory after "+tag+": {x:.2f} GB".format(x=peak_gb))
+    with open('../results/'+folder_name+'/MemoryUsage.txt', 'a') as memory_file:
+        memory_file.write('Peak memory after {tag}: {x:.2f} GB'.format(tag=tag,x=peak_gb)+'\n')
+
+def StackPath(folder_name, name):
+    # Results folder path of intermediate stack name: a chunked volume store, or a .tif with intermediate_store False
+    return '../results/'+folder_name+'/'+name+(volume_store.suffix if intermediate_store else '.tif')
+
+def FindStack(path):
+    # Path of the saved copy of a .tif or chunked volume stack: the chunked volume store if there is one
+    # (and intermediate_store is on), otherwise the .tif, so both results from older versions and .tif names still load
+    base, ext = os.path.splitext(path)
+    if ext.lower() not in ('.tif', volume_store.suffix):
+        return path
+    if intermediate_store and volume_store.is_volume(base+volume_store.suffix):
+        return base+volume_store.suffix
+    return base+'.tif'
+
+def SaveStack(path, stack, tif_copy=False):
+    # Save a stack as a chunked volume store or as a .tif, depending on path (see StackPath)
+    # With tif_copy a chunked volume store is also exported to .tif (see export_tif_copies)
+    if path.endswith(volume_store.suffix):
+        volume_store.save_volume(path, stack)
+        if tif_copy:
+            ExportTifCopy(path)
+    else:
+        io.imsave(path, stack)
+
+def ExportTifCopy(path):
+    # Export a chunked volume store to a .tif of the same name for viewing in ImageJ/FIJI, if export_tif_copies is on
+    if export_tif_copies and volume_store.is_volume(path):
+        volume_store.export_tif(path, os.path.splitext(path)[0]+'.tif')
+
+def LoadStack(path):
+    # Read a whole .tif stack or chunked volume store into memory (see FindStack)
+    path = FindStack(path)
+    if volume_store.is_volume(path):
+        return volume_store.open_volume(path)[:]
+    return io.imread(path)
+
 def load_fullstack(filename,folder_name):
     # print("***LOADING FULL STACK PREDICTION***")
-    #load the model from disk
-    rf = io.imread('../results/'+folder_name+'/'+filename)
+    #load the stack from disk; its chunked volume store is read if there is one
+    rf = LoadStack('../results/'+folder_name+'/'+filename)
     return rf
 
 def displayPixelvalues(stack):
-    pixelVals = np.unique(stack)
+    pixelVals = smooth_stl.class_values(stack)
     for i in range(0,len(pixelVals)):
         print('Class '+str(i)+' has a pixel value of: '+str(pixelVals[i]))
 
-def tif_to_stl(filepath,filename,stl_classes):
-    # Set input filepath and filename
-    # input = '/Users/mattjenkins1/Desktop/Davis_2017/mach_lrn/ML_microCT/results/test1/fullstack_prediction.tif'
-    input = filepath+filename
-    for i in range(0,len(stl_classes)):
-        # Set output filepath and filename
-        hold = int(stl_classes[i])
-        output = filepath+'class'+str(hold)+'_mesh.stl'
-        print('\n...CONVERTING TIF TO STL...')
-        # Read TIFF file into VTK
-        readerVolume = vtk.vtkTIFFReader()
-        readerVolume.SetFileName(input)
-        readerVolume.Update()
-        print('\nThis may take up to 15 minutes per file.\n')
-        # Threshold material of interest based value at index position (e.g. [2] = veins for this leaf)
-        index = np.unique(io.imread(input))[hold]
-        threshold = vtk.vtkImageThreshold()
-        threshold.SetInputConnection(readerVolume.GetOutputPort())
-        threshold.ThresholdBetween(index-1,index+1)  # keep only veins
-        threshold.ReplaceInOn()
-        threshold.SetInValue(0)  # set all values below 400 to 0
-        threshold.ReplaceOutOn()
-        threshold.SetOutValue(1)  # set all values above 400 to 1
-        threshold.Update()
-        # Use marching cubes to generate STL file from TIFF file
-        contour = vtk.vtkDiscreteMarchingCubes()
-        contour.SetInputConnection(threshold.GetOutputPort())
-        contour.GenerateValues(1, 1, 1)
-        contour.Update()
-        # Smooth the mesh
-        #for possible functions check out http://davis.lbl.gov/Manuals/VTK-4.5/classvtkSmoothPolyDataFilter.html#p9
-        smooth = vtk.vtkSmoothPolyDataFilter()
-        smooth.SetInputConnection(contour.GetOutputPort())
-        smooth.SetNumberOfIterations(1000)
-        smooth.BoundarySmoothingOn()
-        smooth.Update()
-        # Decimate the mesh; this removes vertices and fills holes
-        # You might also give this a try
-        # Could help for smoothing
-        # https://www.vtk.org/doc/nightly/html/classvtkDecimatePro.html
-        dec = vtk.vtkDecimatePro()
-        dec.SetInputConnection(smooth.GetOutputPort())
-        dec.SetTargetReduction(0.2) # Tries to reduce dataset to 80% of it's original size
-        dec.PreserveTopologyOn() # Tries to preserve topology
-        dec.Update()
-        print("See 'results/yourfoldername' for mesh file(s).")
-        # Write STL file
-        writer = vtk.vtkSTLWriter()
-        # use this line when NOT using decimate
-        # writer.SetInputConnection(smooth.GetOutputPort()) # Change "smooth" to "dec", for example, if you want to output the decimated STL file
-        # use this line when using decimate
-        writer.SetInputConnection(dec.GetOutputPort()) # Change "smooth" to "dec", for example, if you want to output the decimated STL file
-        writer.SetFileTypeToBinary()
-        writer.SetFileName(output)
-        writer.Write()
+def tif_to_stl(filepath,filename,stl_classes,volume=None):
+    # Write a smoothed .stl mesh of each class in stl_classes to filepath (see smooth_stl.tif_to_stl)
+    # Pass volume when the stack is already loaded to skip reading filename
+    smooth_stl.tif_to_stl(filepath,filename,stl_classes,volume=volume)
 
 def main():
     selection_ = "1"
@@ -1000,7 +1974,7 @@ def main():
                             localthick_up_save(folder_name)
                         elif selection2=="4": #load processed local thickness stack and match array dimensions
                             print("***LOADING LOCAL THICKNESS STACK***")
-                            localthick_stack = io.imread('../results/'+folder_name+'/local_thick_upscale.tif')
+                            localthick_stack = LoadStack(StackPath(folder_name,'local_thick_upscale'))
                             # Match array dimensions to correct for resolution loss due to downsampling when generating local thickness
                             gridrec_stack, localthick_stack = match_array_dim(gridrec_stack,localthick_stack)
                             phaserec_stack, localthick_stack = match_array_dim(phaserec_stack,localthick_stack)
@@ -1011,13 +1985,14 @@ def main():
                             print("\nNot a valid choice.\n")
                 elif selection=="2": #train model
                     selection3="1"
-                    while selection3 != "5":
+                    while selection3 != "6":
                         print("********_____TRAIN MODEL MENU_____********")
                         print("1. Define image subsets for training and testing")
                         print("2. Display stack dimensions for QC") #removed image QC at this stage in pipeline
                         print("3. Train model, then save trained model and feature layer arrays")
                         print("4. Load trained model and feature layer arrays")
-                        print("5. Go back")
+                        print("5. Compare fit time and accuracy for training sample budgets")
+                        print("6. Go back")
                         selection3 = str(input("Select an option (type a number, press enter):\n"))
                         if selection3=="1": #define image subsets for training and testing
                             gridphase_train_slices_subset = [] # resets to empty list or initializes empty list
@@ -1058,14 +2033,23 @@ def main():
                                 print("Okay. Going back.")
                         elif selection3=="4": #load trained model and other arrays from step 4, to skip 1-4 if already ran
                             rf_transverse,FL_train,FL_test,Label_train,Label_test = load_trainmodel(folder_name)
-                        elif selection3=="5": #go back one step
+                        elif selection3=="5": #report fit time and accuracy versus training pixels per class
+                            try:
+                                training_budget_report(FL_train,Label_train,FL_test,Label_test,folder_name)
+                                print("See 'results/"+folder_name+"/TrainingBudget.txt'")
+                            except NameError:
+                                print("\nTrain or load a model first (options 3 or 4).\n")
+                        elif selection3=="6": #go back one step
                             print("Going back one step...")
                         else:
                             print("\nNot a valid choice.\n")
                 elif selection=="3": #examine prediction metrics on training dataset
                     # Print out of bag precition accuracy
                     hold = "1"
-                    print('Our Out Of Box prediction of accuracy is: {oob}%'.format(oob=rf_transverse.oob_score_ * 100))
+                    if hasattr(rf_transverse, "oob_score_"):
+                        print('Our Out Of Box prediction of accuracy is: {oob}%'.format(oob=rf_transverse.oob_score_ * 100))
+                    else:
+                        print('Out Of Box prediction of accuracy is only available for random forest backends')
                     print("Would you like to print feature layer importance?")
                     hold = str(input("Enter 1 for yes, or 2 for no:\n"))
                     if hold == "1":
@@ -1098,30 +2082,67 @@ def main():
                             print("\nNot a valid choice.\n")
                 elif selection=="5": #predict all slices in 3d stack
                     selection5="1"
-                    while selection5 != "3":
+                    while selection5 != "7":
                         print("********_____FULL STACK PREDICTIONS MENU_____********")
                         print("1. Predict full stack and save")
                         print("2. Load existing full stack prediction")
-                        print("3. Go back")
+                        print("3. Predict full stack from disk and save (for stacks larger than memory)")
+                        print("4. Compare coarse-to-fine and exhaustive prediction")
+                        print("5. Predict full stack along several sections and save")
+                        print("6. Compare section ensemble and transverse prediction")
+                        print("7. Go back")
                         selection5 = str(input("Select an option (type a number, press enter):\n"))
                         if selection5=="1": #predict full stack and save
                             print("***PREDICTING FULL STACK***")
-                            RFPredictCTStack_out = RFPredictCTStack(rf_transverse,gridrec_stack,phaserec_stack,localthick_stack,"transverse")
+                            RFPredictCTStack_out = RFPredictCTStack(rf_transverse,gridrec_stack,phaserec_stack,localthick_stack,"transverse",store_dir=PredictionStoreDir(folder_name))
                             print("Would you like to save full stack prediction?")
                             hold = str(input("Enter 1 for yes, or 2 for no:\n"))
                             if hold == "1":
                                 print("***SAVING PREDICTED STACK***")
-                                io.imsave("../results/"+folder_name+"/fullstack_prediction.tif", img_as_ubyte(RFPredictCTStack_out/len(np.unique(RFPredictCTStack_out[1]))))
+                                SaveStack(StackPath(folder_name,'fullstack_prediction'), PredictionToUbyte(RFPredictCTStack_out,len(rf_transverse.classes_)), tif_copy=True)
                                 print("See results folder for 'fullstack_prediction'")
                             else:
                                 print("Okay. Going back.")
                         elif selection5=="2": #load full stack prediction
                             name2 = str(raw_input("Enter filename for existing fullstack prediction (located in your custom results folder):\n(will be 'fullstack_prediction.tif' unless manually altered)\n"))
-                            if os.path.exists('../results/' + folder_name + '/' + name2) == False:
+                            if os.path.exists(FindStack('../results/' + folder_name + '/' + name2)) == False:
                                 print("\nFile is not present in 'results/yourfoldername' or filename was entered incorrectly.\n")
                             else:
                                 RFPredictCTStack_out = load_fullstack(name2,folder_name)
-                        elif selection5=="3": #go back one step
+                        elif selection5=="3": #predict full stack out-of-core, streaming to disk
+                            try:
+                                filepath, grid_name, phase_name
+                            except NameError:
+                                #stacks are read from disk slice by slice, so they need not be loaded with option 1 of the image loading menu
+                                filepath = raw_input("Enter filepath to .tif stacks, relative to MLmicroCT.py (usually '../images/'):\n")
+                                grid_name = raw_input("Enter filename of grid reconstruction .tif stack:\n")
+                                phase_name = raw_input("Enter filename of phase reconstruction .tif stack:\n")
+                            print("***PREDICTING FULL STACK FROM DISK***")
+                            RFPredictCTStackStreaming(rf_transverse,filepath+grid_name,filepath+phase_name,FindStack(StackPath(folder_name,'local_thick_upscale')),StackPath(folder_name,'fullstack_prediction'),store_dir=PredictionStoreDir(folder_name))
+                            ExportTifCopy(StackPath(folder_name,'fullstack_prediction'))
+                            print("See results folder for 'fullstack_prediction'")
+                        elif selection5=="4": #report speed and accuracy of coarse-to-fine prediction
+                            print("***COMPARING COARSE-TO-FINE PREDICTION***")
+                            coarse_to_fine_report(rf_transverse,gridrec_stack,phaserec_stack,localthick_stack,"transverse",folder_name)
+                            print("See 'results/"+folder_name+"/CoarseToFine.txt'")
+                        elif selection5=="5": #predict full stack along each of predict_sections and fuse
+                            print("***PREDICTING FULL STACK ALONG "+", ".join(predict_sections).upper()+" SECTIONS***")
+                            models = section_models(rf_transverse,gridrec_stack,phaserec_stack,label_stack,localthick_stack,gridphase_train_slices_subset,label_train_slices_subset,folder_name)
+                            RFPredictCTStack_out = RFPredictCTStackEnsemble(models,gridrec_stack,phaserec_stack,localthick_stack)
+                            print("Would you like to save full stack prediction?")
+                            hold = str(input("Enter 1 for yes, or 2 for no:\n"))
+                            if hold == "1":
+                                print("***SAVING PREDICTED STACK***")
+                                SaveStack(StackPath(folder_name,'fullstack_prediction'), PredictionToUbyte(RFPredictCTStack_out,len(SectionClasses(models))), tif_copy=True)
+                                print("See results folder for 'fullstack_prediction'")
+                            else:
+                                print("Okay. Going back.")
+                        elif selection5=="6": #report wall-clock and accuracy of the section ensemble
+                            print("***COMPARING SECTION ENSEMBLE AND TRANSVERSE PREDICTION***")
+                            models = section_models(rf_transverse,gridrec_stack,phaserec_stack,label_stack,localthick_stack,gridphase_train_slices_subset,label_train_slices_subset,folder_name)
+                            section_ensemble_report(models,gridrec_stack,phaserec_stack,localthick_stack,label_stack,gridphase_train_slices_subset,gridphase_test_slices_subset,label_train_slices_subset,label_test_slices_subset,folder_name)
+                            print("See 'results/"+folder_name+"/SectionEnsemble.txt'")
+                        elif selection5=="7": #go back one step
                             print("Going back one step...")
                         else:
                             print("\nNot a valid choice.\n")
@@ -1141,7 +2162,7 @@ def main():
                                 RFPredictCTStack_out
                             except NameError:
                                 name2 = raw_input("Enter filename for existing fullstack prediction (located in your custom results folder):\n")
-                                if os.path.exists('../results/'+folder_name+'/'+name2) == False:
+                                if os.path.exists(FindStack('../results/'+folder_name+'/'+name2)) == False:
                                     print("\nFilename incorrect, or file is not in your results folder. Try again.\n")
                                     cog = 1
                                 else:
@@ -1165,7 +2186,7 @@ def main():
                                     print("\nWould you like to save post processed stack?")
                                     hold = str(input("Enter 1 for yes, or 2 for no:\n"))
                                     if hold == "1":
-                                        io.imsave("../results/"+folder_name+"/post_processed_fullstack.tif", processed)
+                                        SaveStack(StackPath(folder_name,'post_processed_fullstack'), processed, tif_copy=True)
                                         print("See results folder for 'post_processed_fullstack'")
                                         name3 = 'post_processed_fullstack.tif'
                                     else:
@@ -1181,11 +2202,11 @@ def main():
                                 processed
                             except NameError:
                                 name3 = str(raw_input("Enter filename for existing post-processed fullstack prediction\n(located in your custom results folder):\n"))
-                                if os.path.exists(mesh_filepath+name3) == False:
+                                if os.path.exists(FindStack(mesh_filepath+name3)) == False:
                                     print("\nFilename incorrect, or file is not in your results folder. Try again.\n")
                                     cog = 1
                                 else:
-                                    processed = io.imread(mesh_filepath+name3)
+                                    processed = LoadStack(mesh_filepath+name3)
                             if cog == 0:
                                 print("\nDisplayed below are your dataset's class numbers and corresponding pixel values.")
                                 print("\nTo select which classes you would like to convert to a 2D mesh (.stl files)\nyou must manually complete the following steps:")
@@ -1196,9 +2217,33 @@ def main():
                                 for z in catch.split(','):
                                     z.strip()
                                     stl_classes.append(z)
-                                tif_to_stl(mesh_filepath,name3,stl_classes)
+                                tif_to_stl(mesh_filepath,None,stl_classes,volume=processed)
                         elif selection6=="3": #trait measurement
-                            print("FIX: update trait measurement")
+                            cog = 0
+                            try:
+                                processed
+                            except NameError:
+                                name3 = str(raw_input("Enter filename for existing post-processed fullstack prediction\n(located in your custom results folder):\n"))
+                                if os.path.exists(FindStack('../results/'+folder_name+'/'+name3)) == False:
+                                    print("\nFilename incorrect, or file is not in your results folder. Try again.\n")
+                                    cog = 1
+                                else:
+                                    processed = load_fullstack(name3,folder_name)
+                            if cog == 0:
+                                print("\nDisplayed below are your dataset's class numbers and corresponding pixel values.")
+                                displayPixelvalues(processed)
+                                try:
+                                    epid_value
+                                except NameError:
+                                    epid_value = int(input("Enter value for epidermis pixels:\n"))
+                                    bg_value = int(input("Enter value for background pixels:\n"))
+                                    spongy_value = int(input("Enter value for spongy mesophyll pixels:\n"))
+                                    palisade_value = int(input("Enter value for palisade mesophyll pixels:\n"))
+                                    ias_value = int(input("Enter value for intercellular air space pixels:\n"))
+                                    vein_value = int(input("Enter value for vein pixels:\n"))
+                                print("***MEASURING LEAF TRAITS***")
+                                measure_leaf_traits(processed,epid_value,bg_value,spongy_value,palisade_value,ias_value,vein_value,folder_name)
+                                print("See results folder for 'LeafTraits.txt' and thickness maps")
                         elif selection6=="4": #go back one step
                             print("Going back one step...")
                         else:
@@ -1209,7 +2254,7 @@ def main():
                         RFPredictCTStack_out
                     except NameError:
                         name4 = raw_input("Enter filename for existing fullstack prediction (located in your custom results folder):\n")
-                        if os.path.exists('../results/'+folder_name+'/'+name4) == False:
+                        if os.path.exists(FindStack('../results/'+folder_name+'/'+name4)) == False:
                             print("\nFilename incorrect, or file is not in your results folder. Try again.\n")
                             cog = 1
                         else:
@@ -1223,7 +2268,7 @@ def main():
                                 processed
                             except NameError:
                                 name4 = raw_input("Enter filename for existing post-procssed fullstack prediction\n(located in your custom results folder):\n")
-                                if os.path.exists('../results/'+folder_name+'/'+name4) == False:
+                                if os.path.exists(FindStack('../results/'+folder_name+'/'+name4)) == False:
                                     print("\nFilename incorrect, or file is not in your results folder. Try again.\n")
                                     cog = 1
                                 else:
@@ -1257,22 +2302,31 @@ def main():
                 if os.path.exists("../results/" + folder_name) == False:
                     os.makedirs("../results/" + folder_name)
                 print("Your custom results folder exists or was created successfully.\nSee folder in 'ML_microCT/results/' directory.\n")
-                #load images
-                gridrec_stack, phaserec_stack, label_stack = Load_images(filepath,grid_name,phase_name,label_name)
+                if not predict_streaming:
+                    #load images
+                    gridrec_stack, phaserec_stack, label_stack = Load_images(filepath,grid_name,phase_name,label_name)
                 if image_process_bool=="1":
                     #generate binary threshold image, invert, downsample and save
-                    Threshold_GridPhase_invert_down(gridrec_stack,phaserec_stack,Th_grid,Th_phase,folder_name)
+                    if predict_streaming:
+                        #thresholding needs the grid and phase stacks in memory; they are released once it is done
+                        Threshold_GridPhase_invert_down(io.imread(filepath+grid_name),io.imread(filepath+phase_name),Th_grid,Th_phase,folder_name)
+                    else:
+                        Threshold_GridPhase_invert_down(gridrec_stack,phaserec_stack,Th_grid,Th_phase,folder_name)
                     #run local thickness, upsample, save
                     localthick_up_save(folder_name)
                 else:
                     print("SKIPPED IMAGE PROCESSING")
                     #load processed local thickness stack and match array dimensions
-                print("***LOADING LOCAL THICKNESS STACK***")
-                localthick_stack = io.imread('../results/'+folder_name+'/local_thick_upscale.tif')
-                # Match array dimensions to correct for resolution loss due to downsampling when generating local thickness
-                gridrec_stack, localthick_stack = match_array_dim(gridrec_stack,localthick_stack)
-                phaserec_stack, localthick_stack = match_array_dim(phaserec_stack,localthick_stack)
-                label_stack, localthick_stack = match_array_dim_label(label_stack,localthick_stack)
+                if predict_streaming:
+                    #open the stacks without reading them; training and prediction read only the slices they use
+                    gridrec_stack, phaserec_stack, label_stack, localthick_stack = Load_images_lazy(filepath,grid_name,phase_name,label_name,FindStack(StackPath(folder_name,'local_thick_upscale')))
+                else:
+                    print("***LOADING LOCAL THICKNESS STACK***")
+                    localthick_stack = LoadStack(StackPath(folder_name,'local_thick_upscale'))
+                    # Match array dimensions to correct for resolution loss due to downsampling when generating local thickness
+                    gridrec_stack, localthick_stack = match_array_dim(gridrec_stack,localthick_stack)
+                    phaserec_stack, localthick_stack = match_array_dim(phaserec_stack,localthick_stack)
+                    label_stack, localthick_stack = match_array_dim_label(label_stack,localthick_stack)
                 #this is just for peoples' feelings, these are defined way earlier...in the .txt file
                 print("***DEFINING IMAGE SUBSETS***")
                 if train_model_bool=="1":
@@ -1280,6 +2334,7 @@ def main():
                     rf_transverse,FL_train,FL_test,Label_train,Label_test = train_model(gridrec_stack,phaserec_stack,label_stack,localthick_stack,gridphase_train_slices_subset,gridphase_test_slices_subset,label_train_slices_subset,label_test_slices_subset)
                     #save trained model and other arrays from step 3 to disk
                     save_trainmodel(rf_transverse,FL_train,FL_test,Label_train,Label_test,folder_name)
+                    report_peak_memory(folder_name,"training")
                 else:
                     print("SKIPPED TRAINING MODEL")
                     #load trained model and other arrays we need
@@ -1300,21 +2355,32 @@ def main():
                 if full_stack_bool=="1":
                     #predict full stack
                     print("***PREDICTING FULL STACK***")
-                    RFPredictCTStack_out = RFPredictCTStack(rf_transverse,gridrec_stack, phaserec_stack, localthick_stack,"transverse")
-                    #save predicted full stack
-                    print("***SAVING PREDICTED STACK***")
-                    io.imsave('../results/'+folder_name+'/fullstack_prediction.tif', img_as_ubyte(RFPredictCTStack_out/len(np.unique(RFPredictCTStack_out[1]))))
+                    if predict_streaming:
+                        #predict slice by slice from disk, writing the prediction as it goes
+                        RFPredictCTStackStreaming(rf_transverse,filepath+grid_name,filepath+phase_name,FindStack(StackPath(folder_name,'local_thick_upscale')),StackPath(folder_name,'fullstack_prediction'),store_dir=PredictionStoreDir(folder_name))
+                        ExportTifCopy(StackPath(folder_name,'fullstack_prediction'))
+                    elif predict_section_ensemble:
+                        #predict along each of predict_sections with its own model and fuse
+                        models = section_models(rf_transverse,gridrec_stack,phaserec_stack,label_stack,localthick_stack,gridphase_train_slices_subset,label_train_slices_subset,folder_name)
+                        RFPredictCTStack_out = RFPredictCTStackEnsemble(models,gridrec_stack,phaserec_stack,localthick_stack)
+                        print("***SAVING PREDICTED STACK***")
+                        SaveStack(StackPath(folder_name,'fullstack_prediction'), PredictionToUbyte(RFPredictCTStack_out,len(SectionClasses(models))), tif_copy=True)
+                    else:
+                        RFPredictCTStack_out = RFPredictCTStack(rf_transverse,gridrec_stack, phaserec_stack, localthick_stack,"transverse",store_dir=PredictionStoreDir(folder_name))
+                        #save predicted full stack
+                        print("***SAVING PREDICTED STACK***")
+                        SaveStack(StackPath(folder_name,'fullstack_prediction'), PredictionToUbyte(RFPredictCTStack_out,len(rf_transverse.classes_)), tif_copy=True)
+                    report_peak_memory(folder_name,"full stack prediction")
                     # performance_metrics(RFPredictCTStack_out,gridphase_test_slices_subset,label_stack,label_test_slices_subset)
                 else:
                     print("SKIPPED FULL STACK PREDICTION")
                 if post_process_bool=="1":
-                    RFPredictCTStack_out = io.imread('../results/'+folder_name+'/fullstack_prediction.tif')
                     print("Post-processing...")
-                    step1 = delete_dangling_epidermis(RFPredictCTStack_out,epid_value,bg_value)
-                    step2 = smooth_epidermis(step1,epid_value,bg_value,spongy_value,palisade_value,ias_value,vein_value)
-                    processed = final_smooth(step2,vein_value,spongy_value,palisade_value,epid_value,ias_value,bg_value)
-                    print("Saving post-processed full stack prediction...")
-                    io.imsave("../results/"+folder_name+"/post_processed_fullstack.tif", img_as_ubyte(processed))
+                    #post-process slab by slab from disk, saving as it goes
+                    PostProcessStack(FindStack(StackPath(folder_name,'fullstack_prediction')),StackPath(folder_name,'post_processed_fullstack'),
+                                     epid_value,bg_value,spongy_value,palisade_value,ias_value,vein_value)
+                    ExportTifCopy(StackPath(folder_name,'post_processed_fullstack'))
+                    report_peak_memory(folder_name,"post-processing")
                     print("See results folder for 'post_processed_fullstack.tif'")
                 else:
                     print("SKIPPED POST-PROCESSING")
@@ -0,0 +1,170 @@
+# Import libraries
+import numpy as np
+from skimage import measure
+from numba import jit
+
+pixel_size = 0.636 # micrometres per pixel side (scans taken at 10x); traits are reported in pixels and in micrometres
+trait_slab_size = 64 # transverse slices processed at a time, bounding the size of temporary masks
+
+def class_volumes(stack):
+    # Number of voxels of each pixel value in stack, as {value: count}
+    # One pass over the stack; 8-bit stacks are counted with bincount instead of sorted
+    if stack.dtype == np.uint8:
+        counts = np.bincount(stack.ravel(), minlength=256)
+        values = np.flatnonzero(counts)
+        return dict(zip(values.tolist(), counts[values].tolist()))
+    values, counts = np.unique(stack, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+def epidermis_bounds(stack, epidermis):
+    # Rows (axis 1) of the epidermis edges in every (z, x) column: outer and inner edge of the upper epidermis,
+    # found in the upper half of the rows, then inner and outer edge of the lower epidermis, found in the lower half
+    # Columns without epidermis in either half are -1 in all four arrays
+    half = stack.shape[1]//2
+    bounds = np.full((4,stack.shape[0],stack.shape[2]), -1, dtype=np.int64)
+    for z0 in range(0, stack.shape[0], trait_slab_size):
+        z1 = min(z0+trait_slab_size, stack.shape[0])
+        upper = stack[z0:z1,0:half,:] == epidermis
+        lower = stack[z0:z1,half:,:] == epidermis
+        valid = upper.any(axis=1) & lower.any(axis=1)
+        bounds[0,z0:z1][valid] = upper.argmax(axis=1)[valid]
+        bounds[1,z0:z1][valid] = (half-1-upper[:,::-1,:].argmax(axis=1))[valid]
+        bounds[2,z0:z1][valid] = (half+lower.argmax(axis=1))[valid]
+        bounds[3,z0:z1][valid] = (stack.shape[1]-1-lower[:,::-1,:].argmax(axis=1))[valid]
+    return bounds
+
+def thickness_maps(bounds):
+    # Mesophyll thickness (rows between the inner epidermis edges) and leaf thickness (outer edge to outer edge,
+    # inclusive) of every (z, x) column in pixels, from epidermis_bounds; NaN where the epidermis is missing
+    valid = bounds[0] >= 0
+    mesophyll_thickness = np.where(valid, bounds[2]-bounds[1]-1, np.nan)
+    leaf_thickness = np.where(valid, bounds[3]-bounds[0]+1, np.nan)
+    return mesophyll_thickness, leaf_thickness
+
+def mesophyll_zone(bounds, z0, z1, rows):
+    # Mask of the voxels between the inner epidermis edges, for slices z0 to z1-1 of a stack with rows rows
+    row = np.arange(rows)[np.newaxis,:,np.newaxis]
+    return (row > bounds[1,z0:z1,np.newaxis,:]) & (row < bounds[2,z0:z1,np.newaxis,:])
+
+def _marching_cubes(volume):
+    # Vertices and faces of the Lewiner marching cubes surface of a volume at level 0.5
+    try:
+        return measure.marching_cubes(volume, 0.5, method="lewiner")[0:2]
+    except AttributeError:
+        return measure.marching_cubes_lewiner(volume, 0.5)[0:2] # scikit-image < 0.19
+
+_cube_areas = None
+
+def cube_areas():
+    # Marching cubes surface area inside a single cube of a binary volume, for each of the 256 corner patterns
+    # (bit dz*4+dy*2+dx set when that corner is inside). Lewiner marching cubes triangulates each cube from its
+    # own corners only, so a volume's surface area is the sum of these over its cubes
+    global _cube_areas
+    if _cube_areas is None:
+        areas = np.zeros(256)
+        cube = np.zeros((2,2,2))
+        for case in range(1,255):
+            for corner in range(8):
+                cube[corner>>2,(corner>>1)&1,corner&1] = (case>>corner)&1
+            verts, faces = _marching_cubes(cube)
+            areas[case] = measure.mesh_surface_area(verts, faces)
+        _cube_areas = areas
+    return _cube_areas
+
+@jit(nopython=True, cache=True)
+def _bit_surface_areas(codes, n_bits, cube_areas, out):
+    # Add the marching cubes surface area of each of the n_bits masks packed as bits of codes to out
+    nz, ny, nx = codes.shape
+    for i in range(nz-1):
+        for j in range(ny-1):
+            for k in range(nx-1):
+                c0 = codes[i,j,k]
+                c1 = codes[i,j,k+1]
+                c2 = codes[i,j+1,k]
+                c3 = codes[i,j+1,k+1]
+                c4 = codes[i+1,j,k]
+                c5 = codes[i+1,j,k+1]
+                c6 = codes[i+1,j+1,k]
+                c7 = codes[i+1,j+1,k+1]
+                # No mask has a surface in cubes whose corners all carry the same code
+                if c0 == c1 and c0 == c2 and c0 == c3 and c0 == c4 and c0 == c5 and c0 == c6 and c0 == c7:
+                    continue
+                for b in range(n_bits):
+                    case = (((c0>>b)&1) | (((c1>>b)&1)<<1) | (((c2>>b)&1)<<2) | (((c3>>b)&1)<<3) |
+                            (((c4>>b)&1)<<4) | (((c5>>b)&1)<<5) | (((c6>>b)&1)<<6) | (((c7>>b)&1)<<7))
+                    out[b] += cube_areas[case]
+
+def surface_areas(codes, n_bits, out=None):
+    # Marching cubes surface areas (pixels^2) of up to 8 masks packed as bits of a uint8 volume, without
+    # building meshes. Summing this over slabs that overlap by one slice gives the area of the whole volume
+    if out is None:
+        out = np.zeros(n_bits)
+    _bit_surface_areas(np.ascontiguousarray(codes, dtype=np.uint8), n_bits, cube_areas(), out)
+    return out
+
+def surface_area(mask):
+    # Area (pixels^2) of the marching cubes surface of a boolean volume, as LeafTraits.ipynb measures it
+    # with marching_cubes_lewiner and mesh_surface_area
+    return float(surface_areas(np.asarray(mask, dtype=bool), 1)[0])
+
+def class_surface_areas(stack, values):
+    # Marching cubes surface area of each pixel value in values (up to 8), in one pass over stack by slabs
+    areas = np.zeros(len(values))
+    for z0 in range(0, stack.shape[0], trait_slab_size):
+        slab = stack[z0:min(z0+trait_slab_size+1, stack.shape[0])] # one slice of overlap: the cubes between slabs
+        codes = np.zeros(slab.shape, dtype=np.uint8)
+        for b, value in enumerate(values):
+            codes |= (slab == value).view(np.uint8) << b
+        surface_areas(codes, len(values), out=areas)
+    return areas
+
+def leaf_traits(stack, epidermis, background, spongy, palisade, ias, vein):
+    # Traits of a post-processed leaf stack with the given class pixel values
+    # Returns rows of (trait, value in pixels, value in micrometres, unit) and the mesophyll and leaf thickness maps
+    # The mesophyll is the region between the inner epidermis edges; its volume excludes IAS and veins,
+    # porosity (theta IAS) is the IAS share of the mesophyll volume including IAS, and Sm is the area of the
+    # mesophyll surface exposed to IAS per projected leaf area
+    bounds = epidermis_bounds(stack, epidermis)
+    mesophyll_thickness, leaf_thickness = thickness_maps(bounds)
+    volumes = class_volumes(stack)
+    # Surface areas of veins, spongy, palisade, IAS and mesophyll including veins (not IAS), packed as bits of
+    # one code per voxel and integrated slab by slab, so no mask of the whole stack or mesh is kept
+    surface_values = (vein, spongy, palisade, ias)
+    areas = np.zeros(len(surface_values)+1)
+    zone_volume = ias_volume = vein_volume = 0
+    for z0 in range(0, stack.shape[0], trait_slab_size):
+        z1 = min(z0+trait_slab_size, stack.shape[0])
+        # One slice of overlap with the next slab: the cubes between slabs
+        z2 = min(z1+1, stack.shape[0])
+        slab = stack[z0:z2]
+        zone = mesophyll_zone(bounds, z0, z2, stack.shape[1])
+        is_ias = slab == ias
+        codes = np.zeros(slab.shape, dtype=np.uint8)
+        for b, value in enumerate(surface_values):
+            codes |= (slab == value).view(np.uint8) << b
+        codes |= (zone & ~is_ias).view(np.uint8) << len(surface_values)
+        surface_areas(codes, len(surface_values)+1, out=areas)
+        n = z1-z0
+        zone_volume += np.count_nonzero(zone[0:n])
+        ias_volume += np.count_nonzero(zone[0:n] & is_ias[0:n])
+        vein_volume += np.count_nonzero(zone[0:n] & (slab[0:n] == vein))
+    mesophyll_volume = zone_volume-ias_volume-vein_volume
+    exposed_area = areas[-1]
+    projected_area = stack.shape[0]*stack.shape[2]
+    traits = []
+    for name, value in (("Epidermis", epidermis), ("Background", background), ("Spongy mesophyll", spongy),
+                        ("Palisade mesophyll", palisade), ("Intercellular air space", ias), ("Vein", vein)):
+        traits.append([name+" volume", volumes.get(value, 0), volumes.get(value, 0)*pixel_size**3, "um^3"])
+    for name, area in zip(("Vein", "Spongy mesophyll", "Palisade mesophyll", "Intercellular air space"), areas):
+        traits.append([name+" surface area", area, area*pixel_size**2, "um^2"])
+    traits += [["Mesophyll volume (without IAS and veins)", mesophyll_volume, mesophyll_volume*pixel_size**3, "um^3"],
+               ["Mesophyll IAS volume", ias_volume, ias_volume*pixel_size**3, "um^3"],
+               ["Porosity (theta IAS)", ias_volume/float(max(mesophyll_volume+ias_volume, 1)), None, ""],
+               ["Mean mesophyll thickness", np.nanmean(mesophyll_thickness), np.nanmean(mesophyll_thickness)*pixel_size, "um"],
+               ["Mean leaf thickness", np.nanmean(leaf_thickness), np.nanmean(leaf_thickness)*pixel_size, "um"],
+               ["Mesophyll surface area exposed to IAS", exposed_area, exposed_area*pixel_size**2, "um^2"],
+               ["Projected leaf area", projected_area, projected_area*pixel_size**2, "um^2"],
+               ["Sm (exposed area per projected leaf area)", exposed_area/projected_area, None, ""],
+               ["Exposed area per mesophyll volume", exposed_area/float(max(mesophyll_volume, 1)),
+                exposed_area/float(max(mesophyll_volume, 1))/pixel_size, "um^-1"]]
+    return traits, mesophyll_thickness, leaf_thickness
@@ -1,64 +1,337 @@
 # Import libraries
+import os
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 from skimage import io
+import tifffile
 import vtk
+from vtk.util import numpy_support
 from tqdm import tqdm
 
-def tif_to_stl(filepath,filename,stl_classes):
-    # Set input filepath and filename
-    # input = '/Users/mattjenkins1/Desktop/Davis_2017/mach_lrn/ML_microCT/results/test1/fullstack_prediction.tif'
-    input = filepath+filename
-    for i in range(0,len(stl_classes)):
-        # Set output filepath and filename
-        hold = int(stl_classes[i])
-        output = filepath+'class'+str(hold)+'_mesh.stl'
-        print('READING TIFF STACK into VTK')
-        # Read TIFF file into VTK
-        readerVolume = vtk.vtkTIFFReader()
-        readerVolume.SetFileName(input)
-        readerVolume.Update()
-        print('Threshold one class at a time')
-        # Threshold material of interest based value at index position (e.g. [2] = veins for this leaf)
-        index = np.unique(io.imread(input))[hold]
-        threshold = vtk.vtkImageThreshold()
-        threshold.SetInputConnection(readerVolume.GetOutputPort())
-        threshold.ThresholdBetween(index-1,index+1)  # keep only veins
-        threshold.ReplaceInOn()
-        threshold.SetInValue(0)  # set all values below 400 to 0
-        threshold.ReplaceOutOn()
-        threshold.SetOutValue(1)  # set all values above 400 to 1
-        threshold.Update()
-        print('MARHCING CUBES')
-        # Use marching cubes to generate STL file from TIFF file
-        contour = vtk.vtkDiscreteMarchingCubes()
-        contour.SetInputConnection(threshold.GetOutputPort())
-        contour.GenerateValues(1, 1, 1)
-        contour.Update()
-        print('SMOOTHING MESH')
-        # Smooth the mesh
-        #for possible functions check out http://davis.lbl.gov/Manuals/VTK-4.5/classvtkSmoothPolyDataFilter.html#p9
-        smooth = vtk.vtkSmoothPolyDataFilter()
-        smooth.SetInputConnection(contour.GetOutputPort())
-        smooth.SetNumberOfIterations(1000)
-        smooth.BoundarySmoothingOn()
-        smooth.Update()
-        print('Decimate the mesh')
-        # Decimate the mesh; this removes vertices and fills holes
-        # You might also give this a try
-        # Could help for smoothing
-        # https://www.vtk.org/doc/nightly/html/classvtkDecimatePro.html
-        dec = vtk.vtkDecimatePro()
-        dec.SetInputConnection(smooth.GetOutputPort())
-        dec.SetTargetReduction(0.2) # Tries to reduce dataset to 80% of it's original size
-        dec.PreserveTopologyOn() # Tries to preserve topology
-        dec.Update()
-        print('WRITING STL FILE')
-        # Write STL file
-        writer = vtk.vtkSTLWriter()
-        # use this line when NOT using decimate
-        # writer.SetInputConnection(smooth.GetOutputPort()) # Change "smooth" to "dec", for example, if you want to output the decimated STL file
-        # use this line when using decimate
-        writer.SetInputConnection(dec.GetOutputPort()) # Change "smooth" to "dec", for example, if you want to output the decimated STL file
-        writer.SetFileTypeToBinary()
-        writer.SetFileName(output)
-        writer.Write()
+mesh_workers = None # worker processes for tif_to_stl, each meshing one class at a time; None uses up to one per core
+mesh_single_pass = False # tif_to_stl meshes all requested classes in one marching cubes pass with shared interfaces (see multi_class_mesh)
+mesh_brick_size = None # tif_to_stl meshes this many slices at a time (see brick_meshes), bounding memory for any stack size; None meshes the whole stack at once
+mesh_brick_halo = 16 # extra slices meshed and smoothed on each side of a brick, then dropped, so bricks join without visible seams
+mesh_brick_reduction = 0.2 # vtkDecimatePro target reduction of each brick's mesh; 0 keeps every triangle
+mesh_format = "stl" # "stl" writes class<number>_mesh.stl per class; "vtp" writes all classes to classes_mesh.vtp (single pass)
+
+def class_values(stack):
+    # Pixel value of each class, in class number order (class i has pixel value class_values(stack)[i])
+    # One pass over the stack; 8-bit stacks are counted with bincount instead of sorted
+    if stack.dtype == np.uint8:
+        return np.flatnonzero(np.bincount(stack.ravel(), minlength=256)).astype(np.uint8)
+    return np.unique(stack)
+
+def volume_to_vtk(volume):
+    # Wrap a (z, y, x) stack as vtkImageData without copying it, laid out as vtkTIFFReader reads the tif
+    volume = np.ascontiguousarray(volume)
+    image = vtk.vtkImageData()
+    image.SetDimensions(volume.shape[2], volume.shape[1], volume.shape[0])
+    # The vtk array keeps a reference to volume, so the memory stays valid as long as image is used
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volume.ravel(), deep=False))
+    return image
+
+def class_contour(image, index):
+    # Discrete marching cubes surface of the voxels of pixel value index in image (see volume_to_vtk)
+    # Threshold material of interest based value at index position (e.g. [2] = veins for this leaf)
+    index = int(index)
+    threshold = vtk.vtkImageThreshold()
+    threshold.SetInputData(image)
+    threshold.ThresholdBetween(index-1,index+1)  # keep only veins
+    threshold.ReplaceInOn()
+    threshold.SetInValue(0)  # set all values below 400 to 0
+    threshold.ReplaceOutOn()
+    threshold.SetOutValue(1)  # set all values above 400 to 1
+    threshold.Update()
+    # Use marching cubes to generate STL file from TIFF file
+    contour = vtk.vtkDiscreteMarchingCubes()
+    contour.SetInputConnection(threshold.GetOutputPort())
+    contour.GenerateValues(1, 1, 1)
+    contour.Update()
+    return contour.GetOutput()
+
+def smooth_mesh(mesh):
+    # Smooth the mesh
+    #for possible functions check out http://davis.lbl.gov/Manuals/VTK-4.5/classvtkSmoothPolyDataFilter.html#p9
+    smooth = vtk.vtkSmoothPolyDataFilter()
+    smooth.SetInputData(mesh)
+    smooth.SetNumberOfIterations(1000)
+    smooth.BoundarySmoothingOn()
+    smooth.Update()
+    return smooth.GetOutput()
+
+def class_mesh(image, index, output):
+    # Mesh the voxels of pixel value index in image (see volume_to_vtk), then smooth, decimate and write an .stl
+    smooth = smooth_mesh(class_contour(image, index))
+    # Decimate the mesh; this removes vertices and fills holes
+    # You might also give this a try
+    # Could help for smoothing
+    # https://www.vtk.org/doc/nightly/html/classvtkDecimatePro.html
+    dec = vtk.vtkDecimatePro()
+    dec.SetInputData(smooth)
+    dec.SetTargetReduction(0.2) # Tries to reduce dataset to 80% of it's original size
+    dec.PreserveTopologyOn() # Tries to preserve topology
+    dec.Update()
+    # Write STL file
+    writer = vtk.vtkSTLWriter()
+    # use this line when NOT using decimate
+    # writer.SetInputConnection(smooth.GetOutputPort()) # Change "smooth" to "dec", for example, if you want to output the decimated STL file
+    # use this line when using decimate
+    writer.SetInputConnection(dec.GetOutputPort()) # Change "smooth" to "dec", for example, if you want to output the decimated STL file
+    writer.SetFileTypeToBinary()
+    writer.SetFileName(output)
+    writer.Write()
+    return output
+
+def multi_class_mesh(image, values, classes):
+    # Mesh the voxels of the class numbers in classes, values being the class pixel values (see class_values),
+    # in one discrete marching cubes pass over image
+    # (see volume_to_vtk). Interfaces between two classes share their vertices, and the mesh is smoothed as a
+    # whole, with a windowed sinc filter that also moves vertices on the interfaces and junctions, so class
+    # surfaces stay consistent with each other. Cells hold their pixel value ("Scalars") and class number ("class")
+    contour = vtk.vtkDiscreteMarchingCubes()
+    contour.SetInputData(image)
+    for i, c in enumerate(classes):
+        contour.SetValue(i, int(values[c]))
+    contour.ComputeScalarsOn()
+    contour.Update()
+    smooth = vtk.vtkWindowedSincPolyDataFilter()
+    smooth.SetInputConnection(contour.GetOutputPort())
+    smooth.SetNumberOfIterations(30)
+    smooth.SetPassBand(0.001)
+    smooth.NonManifoldSmoothingOn()
+    smooth.BoundarySmoothingOn()
+    smooth.NormalizeCoordinatesOn()
+    smooth.Update()
+    mesh = smooth.GetOutput()
+    pixel_values = numpy_support.vtk_to_numpy(mesh.GetCellData().GetScalars())
+    class_array = numpy_support.numpy_to_vtk(np.searchsorted(values, pixel_values).astype(np.int32), deep=True)
+    class_array.SetName("class")
+    mesh.GetCellData().AddArray(class_array)
+    return mesh
+
+def split_class_mesh(mesh, index):
+    # Surface of the cells of pixel value index in a multi_class_mesh, as polydata
+    threshold = vtk.vtkThreshold()
+    threshold.SetInputData(mesh)
+    threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS, vtk.vtkDataSetAttributes.SCALARS)
+    if hasattr(threshold, "SetThresholdFunction"):
+        threshold.SetLowerThreshold(int(index)-0.5)
+        threshold.SetUpperThreshold(int(index)+0.5)
+        threshold.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+    else:
+        threshold.ThresholdBetween(int(index)-0.5, int(index)+0.5) # VTK < 9.1
+    surface = vtk.vtkGeometryFilter()
+    surface.SetInputConnection(threshold.GetOutputPort())
+    surface.Update()
+    return surface.GetOutput()
+
+def read_slices(source, start, stop):
+    # Slices start to stop-1 of a stack given as an array (or memmap) or as a tif filename, read page by page
+    if isinstance(source, str):
+        with tifffile.TiffFile(source) as tif:
+            return tif.asarray(key=range(start, stop), series=0).reshape((stop-start,)+tif.series[0].shape[-2:])
+    return np.asarray(source[start:stop])
+
+def stack_class_values(source, num_slices, brick_size):
+    # class_values of a stack read brick_size slices at a time
+    values = [class_values(read_slices(source, start, min(start+brick_size, num_slices)))
+              for start in range(0, num_slices, brick_size)]
+    return np.unique(np.concatenate(values))
+
+def brick_meshes(slab, start, core_start, core_stop, indices, reduction):
+    # Triangles ((n, 3, 3) float32, stack coordinates) of the meshes of pixel values indices within brick core_start
+    # to core_stop-1, from slab, which holds stack slices start onwards: the brick plus a halo on each side
+    # Each class is meshed and smoothed over the whole slab, then only triangles of marching cubes lying in the
+    # brick are kept. Neighbouring bricks mesh the same cubes around their common face, so every triangle of the
+    # stack's mesh is kept by exactly one brick, and the halo makes both sides smooth the face alike
+    image = volume_to_vtk(slab)
+    image.SetOrigin(0, 0, start)
+    triangles = []
+    for index in indices:
+        contour = class_contour(image, index)
+        if contour.GetNumberOfCells() == 0:
+            triangles.append(np.empty((0,3,3), dtype=np.float32))
+            continue
+        # Smoothing keeps point and cell order, so marching cubes positions index the smoothed mesh
+        cube_z = numpy_support.vtk_to_numpy(contour.GetPoints().GetData())[:,2].copy()
+        smooth = smooth_mesh(contour)
+        polys = numpy_support.vtk_to_numpy(smooth.GetPolys().GetConnectivityArray()).reshape((-1,3))
+        centre_z = cube_z[polys].mean(axis=1)
+        polys = polys[(centre_z >= core_start) & (centre_z < core_stop)]
+        points = numpy_support.vtk_to_numpy(smooth.GetPoints().GetData())
+        if reduction > 0 and len(polys) > 0:
+            # Decimate the brick; boundary vertices are kept so bricks still meet along the same edges
+            cells = vtk.vtkCellArray()
+            cells.SetData(numpy_support.numpy_to_vtk(np.arange(0, 3*len(polys)+1, 3), deep=True, array_type=vtk.VTK_ID_TYPE),
+                          numpy_support.numpy_to_vtk(polys.ravel(), deep=True, array_type=vtk.VTK_ID_TYPE))
+            core = vtk.vtkPolyData()
+            core.SetPoints(smooth.GetPoints())
+            core.SetPolys(cells)
+            dec = vtk.vtkDecimatePro()
+            dec.SetInputData(core)
+            dec.SetTargetReduction(reduction)
+            dec.PreserveTopologyOn()
+            dec.BoundaryVertexDeletionOff()
+            dec.Update()
+            points = numpy_support.vtk_to_numpy(dec.GetOutput().GetPoints().GetData())
+            polys = numpy_support.vtk_to_numpy(dec.GetOutput().GetPolys().GetConnectivityArray()).reshape((-1,3))
+        triangles.append(points[polys].astype(np.float32))
+    return triangles
+
+class STLStreamWriter(object):
+    # Binary .stl file written a batch of triangles at a time; the triangle count is filled in by close()
+    def __init__(self, filename):
+        self._file = open(filename, "wb")
+        self._file.write(b"tif_to_stl".ljust(80, b" "))
+        self._file.write(np.uint32(0).tobytes())
+        self.count = 0
+
+    def write(self, triangles):
+        # Add (n, 3, 3) triangles, with unit normals as vtkSTLWriter computes them
+        records = np.zeros(len(triangles), dtype=[("normal","<f4",(3,)),("vertices","<f4",(3,3)),("attribute","<u2")])
+        normals = np.cross(triangles[:,1]-triangles[:,0], triangles[:,2]-triangles[:,0])
+        length = np.sqrt((normals**2).sum(axis=1))
+        records["normal"] = normals/np.where(length > 0, length, 1)[:,np.newaxis]
+        records["vertices"] = triangles
+        self._file.write(records.tobytes())
+        self.count += len(triangles)
+
+    def close(self):
+        self._file.seek(80)
+        self._file.write(np.uint32(self.count).tobytes())
+        self._file.close()
+
+def _InitBrickWorker(source, indices, reduction):
+    # Runs once in each brick mesh worker; source is a tif filename or the path of a shared .npy stack
+    global _mesh_worker
+    if source.endswith(".npy"):
+        source = np.load(source, mmap_mode="r")
+    _mesh_worker = {"source": source, "indices": indices, "reduction": reduction}
+
+def _BrickMeshWorker(brick):
+    start, stop, core_start, core_stop = brick
+    return brick_meshes(read_slices(_mesh_worker["source"], start, stop), start, core_start, core_stop,
+                        _mesh_worker["indices"], _mesh_worker["reduction"])
+
+def tif_to_stl_bricks(filepath, filename, stl_classes, volume=None, brick_size=None, n_workers=None, tmp_dir=None):
+    # Write 'class<number>_mesh.stl' for each class number in stl_classes, meshing brick_size slices at a time
+    # (see mesh_brick_size) in a process pool; each brick's triangles are appended to the .stl files as it
+    # finishes, so memory is bounded by a few bricks. The tif is read brick by brick unless volume is given
+    if brick_size is None:
+        brick_size = mesh_brick_size
+    halo = max(mesh_brick_halo, 1) # bricks must overlap by at least one slice to share their face cubes
+    source = filepath+filename if volume is None else volume
+    if volume is None:
+        with tifffile.TiffFile(source) as tif:
+            num_slices = tif.series[0].shape[0]
+    else:
+        num_slices = volume.shape[0]
+    print('FINDING CLASS VALUES')
+    values = stack_class_values(source, num_slices, brick_size)
+    classes = [int(c) for c in stl_classes]
+    indices = [values[c] for c in classes]
+    bricks = [(max(core_start-halo, 0), min(core_start+brick_size+halo, num_slices), core_start, min(core_start+brick_size, num_slices))
+              for core_start in range(0, num_slices, brick_size)]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count() if mesh_workers is None else mesh_workers
+    n_workers = min(n_workers, len(bricks))
+    writers = [STLStreamWriter(filepath+'class'+str(c)+'_mesh.stl') for c in classes]
+    shared_dir = None
+    pool = None
+    try:
+        print('MESHING {} CLASSES IN {} BRICKS'.format(len(classes), len(bricks)))
+        if n_workers <= 1:
+            meshed_bricks = (brick_meshes(read_slices(source, *brick[0:2]), brick[0], brick[2], brick[3], indices, mesh_brick_reduction)
+                             for brick in bricks)
+        else:
+            if volume is not None:
+                # Share the stack with the workers through a memory-mapped file instead of pickling it per worker
+                shared_dir = tempfile.mkdtemp(prefix="tif_to_stl_", dir=tmp_dir)
+                source = os.path.join(shared_dir, "volume.npy")
+                np.save(source, volume)
+            pool = multiprocessing.Pool(n_workers, initializer=_InitBrickWorker, initargs=(source, indices, mesh_brick_reduction))
+            meshed_bricks = pool.imap(_BrickMeshWorker, bricks)
+        for triangles in tqdm(meshed_bricks, total=len(bricks)):
+            for writer, class_triangles in zip(writers, triangles):
+                writer.write(class_triangles)
+    finally:
+        for writer in writers:
+            writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if shared_dir is not None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+def _InitMeshWorker(volume_path):
+    # Runs once in each mesh worker: wrap the shared memory-mapped stack for VTK
+    global _mesh_worker
+    # Copy-on-write mapping: pages are shared with the other workers and only read
+    _mesh_worker = {"image": volume_to_vtk(np.load(volume_path, mmap_mode="c"))}
+
+def _ClassMeshWorker(task):
+    index, output = task
+    return class_mesh(_mesh_worker["image"], index, output)
+
+def tif_to_stl(filepath,filename,stl_classes,volume=None,n_workers=None,tmp_dir=None,single_pass=None,out_format=None):
+    # Write 'class<number>_mesh.stl' to filepath for each class number in stl_classes
+    # The stack is read once (or taken from volume when already loaded), class values are looked up once,
+    # and classes are meshed concurrently in a process pool of n_workers (see mesh_workers)
+    # With single_pass (see mesh_single_pass) all classes are meshed together by multi_class_mesh; the "vtp"
+    # out_format (see mesh_format) then writes them to a single 'classes_mesh.vtp' with a "class" cell array
+    # With mesh_brick_size set, .stl files are written brick by brick (see tif_to_stl_bricks)
+    if single_pass is None:
+        single_pass = mesh_single_pass
+    if out_format is None:
+        out_format = mesh_format
+    if mesh_brick_size is not None and not single_pass and out_format == "stl":
+        return tif_to_stl_bricks(filepath,filename,stl_classes,volume=volume,n_workers=n_workers,tmp_dir=tmp_dir)
+    if volume is None:
+        print('READING TIFF STACK')
+        volume = io.imread(filepath+filename)
+    values = class_values(volume)
+    if single_pass or out_format == "vtp":
+        classes = [int(c) for c in stl_classes]
+        print('MESHING {} CLASSES IN ONE PASS'.format(len(classes)))
+        mesh = multi_class_mesh(volume_to_vtk(volume), values, classes)
+        if out_format == "vtp":
+            writer = vtk.vtkXMLPolyDataWriter()
+            writer.SetInputData(mesh)
+            writer.SetFileName(filepath+'classes_mesh.vtp')
+            writer.Write()
+            return
+        for c in tqdm(classes):
+            writer = vtk.vtkSTLWriter()
+            writer.SetInputData(split_class_mesh(mesh, values[c]))
+            writer.SetFileTypeToBinary()
+            writer.SetFileName(filepath+'class'+str(c)+'_mesh.stl')
+            writer.Write()
+        return
+    tasks = [(values[int(c)], filepath+'class'+str(int(c))+'_mesh.stl') for c in stl_classes]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count() if mesh_workers is None else mesh_workers
+    n_workers = min(n_workers, len(tasks))
+    print('MESHING {} CLASSES'.format(len(tasks)))
+    if n_workers <= 1:
+        image = volume_to_vtk(volume)
+        for index, output in tqdm(tasks):
+            class_mesh(image, index, output)
+        return
+    # Share the stack with the workers through a memory-mapped file instead of pickling it per worker
+    shared_dir = tempfile.mkdtemp(prefix="tif_to_stl_", dir=tmp_dir)
+    try:
+        volume_path = os.path.join(shared_dir, "volume.npy")
+        np.save(volume_path, volume)
+        pool = multiprocessing.Pool(n_workers, initializer=_InitMeshWorker, initargs=(volume_path,))
+        try:
+            # One class per task, so the slowest classes do not queue behind each other
+            for output in tqdm(pool.imap_unordered(_ClassMeshWorker, tasks, chunksize=1), total=len(tasks)):
+                print('WROTE '+output)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
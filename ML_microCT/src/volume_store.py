@@ -0,0 +1,240 @@
+# Import libraries
+import os
+import json
+import zlib
+import shutil
+import itertools
+import collections
+import numpy as np
+import tifffile
+
+suffix = ".chunks" # folder suffix of chunked volume stores
+chunk_shape = (16, 256, 256) # (z, y, x) voxels per chunk; chunks are read, compressed and written independently
+compress_level = 1 # zlib level (1-9) of each chunk; 0 stores chunks uncompressed
+cache_chunks = 64 # decoded chunks kept by each open volume, so reading a band of chunks slice by slice decodes it once
+
+_meta_name = "volume.json"
+
+def is_volume(path):
+    # True if path is a chunked volume store
+    return os.path.isfile(os.path.join(path, _meta_name))
+
+class ChunkedVolume(object):
+    # Array-like 3D stack kept as a folder of independently compressed chunks (one file each) and a volume.json
+    # Indexing decodes only the chunks it touches; chunks never written read as zeros. Processes writing
+    # disjoint sets of whole chunks can write concurrently; each chunk file is replaced atomically
+    def __init__(self, path, shape=None):
+        self.path = path
+        with open(os.path.join(path, _meta_name)) as meta_file:
+            meta = json.load(meta_file)
+        self.dtype = np.dtype(meta["dtype"])
+        self.stored_shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.compress_level = meta["compress_level"]
+        self.shape = self.stored_shape if shape is None else tuple(shape) # shape may crop the stack
+        self.ndim = len(self.shape)
+        self._cache = collections.OrderedDict()
+
+    def _chunk_file(self, chunk):
+        return os.path.join(self.path, ".".join(str(c) for c in chunk))
+
+    def _chunk_extent(self, chunk):
+        return tuple(min(size, n-c*size) for c, size, n in zip(chunk, self.chunks, self.stored_shape))
+
+    def _read_chunk(self, chunk):
+        # Decoded chunk (read-only), or None if it was never written
+        if chunk in self._cache:
+            self._cache[chunk] = self._cache.pop(chunk)
+            return self._cache[chunk]
+        try:
+            with open(self._chunk_file(chunk), "rb") as chunk_file:
+                data = chunk_file.read()
+        except IOError:
+            return None
+        if self.compress_level:
+            data = zlib.decompress(data)
+        array = np.frombuffer(data, dtype=self.dtype).reshape(self._chunk_extent(chunk))
+        self._cache[chunk] = array
+        while len(self._cache) > cache_chunks:
+            self._cache.popitem(last=False)
+        return array
+
+    def _write_chunk(self, chunk, array):
+        # Written chunks are dropped from the cache rather than kept, so writers hold no decoded chunks
+        self._cache.pop(chunk, None)
+        data = np.ascontiguousarray(array, dtype=self.dtype).tobytes()
+        if self.compress_level:
+            data = zlib.compress(data, self.compress_level)
+        # Write to a temporary name and rename, so readers never see a partly written chunk
+        tmp_path = self._chunk_file(chunk)+".{pid}.tmp".format(pid=os.getpid())
+        with open(tmp_path, "wb") as chunk_file:
+            chunk_file.write(data)
+        if os.name == "nt" and os.path.exists(self._chunk_file(chunk)):
+            os.remove(self._chunk_file(chunk)) # rename does not replace files on Windows
+        os.rename(tmp_path, self._chunk_file(chunk))
+
+    def _region(self, index):
+        # Box (start, stop on each axis) that an index touches, the same index relative to the box, and whether
+        # that index takes the whole box (integers and step 1 slices only)
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index+(slice(None),)*(self.ndim-len(index))
+        bounds = []
+        inner = []
+        whole = True
+        for i, n in zip(index, self.shape):
+            if isinstance(i, slice):
+                indices = range(*i.indices(n))
+                if len(indices) == 0:
+                    bounds.append((0, 0))
+                    inner.append(slice(None))
+                    continue
+                start = min(indices[0], indices[-1])
+                bounds.append((start, max(indices[0], indices[-1])+1))
+                inner.append(slice(indices[0]-start, None, i.indices(n)[2]))
+                whole = whole and inner[-1].step == 1
+            elif isinstance(i, (int, np.integer)):
+                k = int(i)+n if i < 0 else int(i)
+                if not 0 <= k < n:
+                    raise IndexError("index {i} is out of bounds for axis with size {n}".format(i=i, n=n))
+                bounds.append((k, k+1))
+                inner.append(0)
+            else:
+                k = np.asarray(i, dtype=np.int64)
+                k = np.where(k < 0, k+n, k)
+                start = int(k.min()) if k.size else 0
+                bounds.append((start, int(k.max())+1 if k.size else 0))
+                inner.append(k-start)
+                whole = False
+        return bounds, tuple(inner), whole
+
+    def _chunks_in(self, bounds):
+        # Chunks overlapping a box, with the overlap in chunk and in box coordinates
+        if any(stop <= start for start, stop in bounds):
+            return
+        ranges = [range(start//size, (stop-1)//size+1) for (start, stop), size in zip(bounds, self.chunks)]
+        for chunk in itertools.product(*ranges):
+            in_chunk = []
+            in_box = []
+            for c, size, (start, stop) in zip(chunk, self.chunks, bounds):
+                lo = max(start, c*size)
+                hi = min(stop, (c+1)*size)
+                in_chunk.append(slice(lo-c*size, hi-c*size))
+                in_box.append(slice(lo-start, hi-start))
+            yield chunk, tuple(in_chunk), tuple(in_box)
+
+    def _read_box(self, bounds):
+        box = np.zeros([stop-start for start, stop in bounds], dtype=self.dtype)
+        for chunk, in_chunk, in_box in self._chunks_in(bounds):
+            array = self._read_chunk(chunk)
+            if array is not None:
+                box[in_box] = array[in_chunk]
+        return box
+
+    def __getitem__(self, index):
+        bounds, inner, whole = self._region(index)
+        return self._read_box(bounds)[inner]
+
+    def __setitem__(self, index, value):
+        bounds, inner, whole = self._region(index)
+        box = np.empty([stop-start for start, stop in bounds], dtype=self.dtype) if whole else self._read_box(bounds)
+        box[inner] = value
+        for chunk, in_chunk, in_box in self._chunks_in(bounds):
+            extent = self._chunk_extent(chunk)
+            if all(s.stop-s.start == e for s, e in zip(in_chunk, extent)):
+                self._write_chunk(chunk, box[in_box])
+            else:
+                # Partly covered chunk: merge with what is stored
+                array = self._read_chunk(chunk)
+                array = np.zeros(extent, dtype=self.dtype) if array is None else array.copy()
+                array[in_chunk] = box[in_box]
+                self._write_chunk(chunk, array)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # Reopen the store in worker processes instead of pickling decoded chunks
+        return {"path": self.path, "shape": self.shape}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["shape"])
+
+def create_volume(path, shape, dtype, chunks=None, level=None):
+    # Create an empty chunked volume store at path, replacing any store there
+    if chunks is None:
+        chunks = chunk_shape
+    if level is None:
+        level = compress_level
+    if is_volume(path):
+        shutil.rmtree(path)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    meta = {"shape": [int(n) for n in shape], "dtype": np.dtype(dtype).str,
+            "chunks": [int(min(c, max(n, 1))) for c, n in zip(chunks, shape)], "compress_level": int(level)}
+    with open(os.path.join(path, _meta_name), "w") as meta_file:
+        json.dump(meta, meta_file)
+    return ChunkedVolume(path)
+
+def open_volume(path, shape=None):
+    # Open a chunked volume store without reading it, optionally cropped to shape
+    return ChunkedVolume(path, shape)
+
+def save_volume(path, stack, chunks=None):
+    # Save an array (or any stack indexable along axis 0, e.g. a lazily read tif) as a chunked volume store,
+    # one band of chunks at a time
+    volume = create_volume(path, stack.shape, stack.dtype, chunks)
+    for z in range(0, stack.shape[0], volume.chunks[0]):
+        volume[z:z+volume.chunks[0]] = np.asarray(stack[z:z+volume.chunks[0]])
+    return volume
+
+def export_tif(path, filename):
+    # Write a chunked volume store to a multi-page tif (e.g. for ImageJ/FIJI), one band of chunks at a time
+    volume = open_volume(path)
+    with tifffile.TiffWriter(filename, bigtiff=True) as writer:
+        for z in range(0, volume.shape[0], volume.chunks[0]):
+            for img in volume[z:z+volume.chunks[0]]:
+                writer.write(img, contiguous=True, photometric="minisblack")
+
+class SliceWriter(object):
+    # Write a stack slice by slice, in order, to a new chunked volume store (a band of chunks at a time)
+    # or, for filenames ending in .tif, to a multi-page tif
+    def __init__(self, path, shape, dtype, chunks=None):
+        self._tif = None
+        self._volume = None
+        if path.lower().endswith((".tif", ".tiff")):
+            self._tif = tifffile.TiffWriter(path, bigtiff=True)
+        else:
+            self._volume = create_volume(path, shape, dtype, chunks)
+            self._band = np.empty((self._volume.chunks[0],)+tuple(shape[1:]), dtype=dtype)
+            self._z = 0
+            self._n = 0
+
+    def write(self, img):
+        if self._tif is not None:
+            self._tif.write(img, contiguous=True, photometric="minisblack")
+            return
+        self._band[self._n] = img
+        self._n += 1
+        if self._n == len(self._band):
+            self.flush()
+
+    def flush(self):
+        if self._volume is not None and self._n:
+            self._volume[self._z:self._z+self._n] = self._band[0:self._n]
+            self._z += self._n
+            self._n = 0
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -4,7 +4,7 @@ import numpy as np
 import smooth_stl
 
 def displayPixelvalues(stack):
-    pixelVals = np.unique(stack)
+    pixelVals = smooth_stl.class_values(stack)
     for i in range(0,len(pixelVals)):
         print('Class '+str(i)+' has a pixel value of: '+str(pixelVals[i]))
 
@@ -23,7 +23,7 @@ def main():
         z.strip()
         stl_classes.append(z)
     print(stl_classes)
-    smooth_stl.tif_to_stl(filepath,filename,stl_classes)
+    smooth_stl.tif_to_stl(filepath,filename,stl_classes,volume=stack)
 
 
 if __name__ == '__main__':